@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Streaming Batch Benchmark
+Measures images/sec of the batched SDXL-Turbo path for several batch sizes.
+Defaults to a tiny test pipeline on CPU so it runs anywhere:
+
+    python benchmark_streaming_batch.py --batch-sizes 1 2 4 8
+    python benchmark_streaming_batch.py --model stabilityai/sdxl-turbo --device cuda --size 512
+"""
+
+import time
+import argparse
+import torch
+from diffusers import AutoPipelineForText2Image
+
+from models import StreamingGenerativeRequest
+from generative_service import generative_service
+
+TINY_PIPELINE = "hf-internal-testing/tiny-stable-diffusion-xl-pipe"
+
+def load_pipeline(model_id: str, device: str):
+    """Load a text-to-image pipeline for benchmarking"""
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    pipe = AutoPipelineForText2Image.from_pretrained(model_id, torch_dtype=dtype)
+    pipe.set_progress_bar_config(disable=True)
+    return pipe.to(device)
+
+def benchmark(pipe, batch_size: int, size: int, steps: int, rounds: int) -> float:
+    """Images per second for one batch size"""
+    requests = [
+        StreamingGenerativeRequest(
+            prompt=f"a watercolor fox, variation {i}",
+            num_inference_steps=steps,
+            width=size,
+            height=size
+        )
+        for i in range(batch_size)
+    ]
+
+    # Warm-up call (allocations, kernel selection)
+    generative_service._run_streaming_pipeline(pipe, requests)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        generative_service._run_streaming_pipeline(pipe, requests)
+    elapsed = time.perf_counter() - start
+
+    return batch_size * rounds / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched streaming generation")
+    parser.add_argument("--model", default=TINY_PIPELINE)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--size", type=int, default=256, help="Image width and height")
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"⚡ STREAMING BATCH BENCHMARK - {args.model} on {args.device}")
+    print("=" * 60)
+
+    pipe = load_pipeline(args.model, args.device)
+
+    baseline = None
+    for batch_size in args.batch_sizes:
+        throughput = benchmark(pipe, batch_size, args.size, args.steps, args.rounds)
+        baseline = baseline or throughput
+        print(f"📦 batch {batch_size:>2}: {throughput:8.2f} images/sec ({throughput / baseline:.2f}x)")
+
+if __name__ == "__main__":
+    main()
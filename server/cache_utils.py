@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from models import CacheStats
+
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """Bounded least-recently-used cache with optional TTL, optional on-disk tier and hit/miss accounting"""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        disk_dir: Optional[str] = None,
+        disk_max_entries: int = 10000,
+        on_evict: Optional[Callable[[Hashable], None]] = None
+    ):
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl
+        self.on_evict = on_evict  # Called (under the cache lock) when an entry is evicted or expires
+        self.disk_dir = os.path.abspath(disk_dir) if disk_dir else None
+        self.disk_max_entries = disk_max_entries
+
+        # key -> (value, expires_at or None)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return cached value and mark it as most recently used"""
+        entry = self._get_memory(key)
+        if entry is None and self.disk_dir:
+            entry = self._get_disk(key)
+        return self._finish_get(entry, default)
+
+    async def aget(self, key: Hashable, default: Any = None) -> Any:
+        """get() for async callers: a disk-tier lookup runs in a worker thread"""
+        entry = self._get_memory(key)
+        if entry is None and self.disk_dir:
+            entry = await asyncio.to_thread(self._get_disk, key)
+        return self._finish_get(entry, default)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Insert or refresh a value, evicting the least recently used entry when full"""
+        expires_at = self._set_memory(key, value)
+        if self.disk_dir:
+            self._write_disk(key, value, expires_at)
+
+    async def aset(self, key: Hashable, value: Any) -> None:
+        """set() for async callers: the disk-tier write runs in a worker thread"""
+        expires_at = self._set_memory(key, value)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, value, expires_at)
+
+    def _get_memory(self, key: Hashable) -> Optional[Tuple[Any]]:
+        """(value,) from the memory tier, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return (value,)
+
+            # Expired
+            del self._entries[key]
+            self._notify_evicted(key)
+            return None
+
+    def _get_disk(self, key: Hashable) -> Optional[Tuple[Any]]:
+        """(value,) from the disk tier (JSON-serializable values with string keys only), promoted to memory"""
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        with self._lock:
+            self._store(key, value, expires_at)
+            self.disk_hits += 1
+        return (value,)
+
+    def _finish_get(self, entry: Optional[Tuple[Any]], default: Any) -> Any:
+        if entry is not None:
+            return entry[0]
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def _set_memory(self, key: Hashable, value: Any) -> Optional[float]:
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._store(key, value, expires_at)
+        return expires_at
+
+    def _store(self, key: Hashable, value: Any, expires_at: Optional[float]) -> None:
+        """Insert into the memory tier (caller holds the lock)"""
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._notify_evicted(evicted_key)
+
+    def _notify_evicted(self, key: Hashable) -> None:
+        if self.on_evict is not None:
+            try:
+                self.on_evict(key)
+            except Exception as e:
+                logger.warning(f"⚠️ Cache eviction callback failed: {e}")
+
+    def _disk_path(self, key: Hashable) -> str:
+        digest = hashlib.sha256(str(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.json")
+
+    def _read_disk(self, key: Hashable) -> Optional[Tuple[Any, Optional[float]]]:
+        """Load an entry from the disk tier, dropping it if expired"""
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Unreadable cache file {path}: {e}")
+            return None
+
+        expires_at = record.get('expires_at')
+        if record.get('key') != str(key) or (expires_at is not None and expires_at <= time.time()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # Touch so that disk pruning is least-recently-used too
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return record.get('value'), expires_at
+
+    def _write_disk(self, key: Hashable, value: Any, expires_at: Optional[float]) -> None:
+        """Persist an entry to the disk tier"""
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'key': str(key), 'value': value, 'expires_at': expires_at}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Could not write cache file {path}: {e}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % 64 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Remove least recently used files beyond disk_max_entries"""
+        try:
+            files = [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return
+
+        if len(files) <= self.disk_max_entries:
+            return
+
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.disk_max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        """Drop all in-memory entries (counters and disk tier are kept)"""
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / total if total else 0.0
+
+    def get_stats(self) -> CacheStats:
+        """Get cache statistics"""
+        return CacheStats(
+            total_entries=len(self._entries),
+            max_entries=self.max_size,
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=self.hit_rate
+        )
+
+class BlobCache:
+    """Disk-backed cache of byte blobs with a total size quota and least-recently-used eviction
+
+    Each blob is stored as <key><suffix>; with an empty suffix the key is the whole filename.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, suffix: str = '.bin'):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+        # key -> size in bytes, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
+
+    def _load_index(self) -> None:
+        """Rebuild the LRU index from files left by a previous run (oldest access first)"""
+        try:
+            files = [
+                entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(self.suffix) and not entry.name.endswith('.tmp')
+            ]
+        except OSError:
+            return
+
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        with self._lock:
+            for entry in files:
+                size = entry.stat().st_size
+                self._index[entry.name[:len(entry.name) - len(self.suffix)]] = size
+                self.total_bytes += size
+            self._evict_over_quota()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached bytes and mark them as most recently used"""
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.total_bytes -= self._index.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        """Store bytes, evicting least recently used blobs beyond the quota"""
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write cache blob {path}: {e}")
+            return
+
+        with self._lock:
+            self.total_bytes += len(data) - self._index.get(key, 0)
+            self._index[key] = len(data)
+            self._index.move_to_end(key)
+            self._evict_over_quota()
+
+    def _evict_over_quota(self) -> None:
+        """Remove least recently used blobs until within the quota (caller holds the lock)"""
+        while self.total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_stats(self) -> CacheStats:
+        """Get cache statistics (memory_usage is the disk usage in MB)"""
+        return CacheStats(
+            total_entries=len(self._index),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=self.hit_rate,
+            memory_usage=self.total_bytes / (1024 * 1024)
+        )
@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Approximate per-message bookkeeping cost on top of the UTF-8 text itself
+MESSAGE_OVERHEAD_BYTES = 120
+
+class ChatMessage:
+    """Compact conversation message record"""
+
+    __slots__ = ('role', 'content', 'timestamp')
+
+    def __init__(self, role: str, content: str, timestamp: float = None):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.content.encode('utf-8')) + MESSAGE_OVERHEAD_BYTES
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'role': self.role, 'content': self.content, 'timestamp': self.timestamp}
+
+class Conversation:
+    """Bounded message history of a single conversation plus a rolling summary of older turns"""
+
+    __slots__ = ('messages', 'size_bytes', 'last_access', 'summary', 'appended', 'summarized')
+
+    def __init__(self, max_messages: int):
+        self.messages: Deque[ChatMessage] = deque(maxlen=max_messages)
+        self.size_bytes = 0
+        self.last_access = time.time()
+        self.summary = ""
+        self.appended = 0  # Messages ever appended
+        self.summarized = 0  # Leading messages (of those appended) covered by the summary
+
+    def append(self, message: ChatMessage) -> None:
+        if len(self.messages) == self.messages.maxlen:
+            self.size_bytes -= self.messages[0].size_bytes
+        self.messages.append(message)
+        self.size_bytes += message.size_bytes
+        self.appended += 1
+        self.last_access = time.time()
+
+    def set_summary(self, summary: str, summarized: int) -> None:
+        self.size_bytes += len(summary.encode('utf-8')) - len(self.summary.encode('utf-8'))
+        self.summary = summary
+        self.summarized = summarized
+
+class ConversationStore:
+    """Conversation memory with a global byte budget, LRU and idle-TTL eviction and optional spill to disk
+
+    Conversations evicted for the byte budget are spilled to disk (written off the event loop) and read
+    back by load(); conversations that expire are dropped. Spill files expire after the idle TTL too,
+    and their total size is capped by spill_max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = None,
+        idle_ttl: float = None,
+        max_messages: int = None,
+        spill_dir: Optional[str] = None,
+        spill_max_bytes: int = None
+    ):
+        self.max_bytes = max_bytes or int(os.getenv('STUDY_CONVERSATION_MAX_BYTES', str(32 * 1024 * 1024)))
+        self.idle_ttl = idle_ttl or float(os.getenv('STUDY_CONVERSATION_TTL_SECONDS', '3600'))
+        self.max_messages = max_messages or int(os.getenv('STUDY_CONVERSATION_MAX_MESSAGES', '20'))
+        spill_dir = spill_dir or os.getenv('STUDY_CONVERSATION_SPILL_DIR')
+        self.spill_dir = os.path.abspath(spill_dir) if spill_dir else None
+        self.spill_max_bytes = spill_max_bytes or int(os.getenv('STUDY_CONVERSATION_SPILL_MAX_BYTES', str(256 * 1024 * 1024)))
+
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spilled = 0
+        self.restored = 0
+        self.spill_expirations = 0
+
+        # Evicted conversations waiting to be written (conversation_id -> spill record)
+        self._pending_spills: Dict[str, Dict[str, Any]] = {}
+        self._spill_task: Optional[asyncio.Task] = None
+        self._io_lock: Optional[asyncio.Lock] = None
+
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        return conversation_id in self._conversations or conversation_id in self._pending_spills
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def append(self, conversation_id: str, role: str, content: str) -> None:
+        """Add a message to a conversation, evicting least recently used conversations when over budget"""
+        conversation = self._get_conversation(conversation_id)
+        if conversation is None:
+            conversation = Conversation(self.max_messages)
+            self._conversations[conversation_id] = conversation
+
+        self.total_bytes -= conversation.size_bytes
+        conversation.append(ChatMessage(role, content))
+        self.total_bytes += conversation.size_bytes
+        self._conversations.move_to_end(conversation_id)
+
+        self._enforce_budget(keep=conversation_id)
+
+    def add_exchange(self, conversation_id: str, message: str, response_text: str) -> None:
+        """Store a question/answer pair"""
+        self.append(conversation_id, 'user', message)
+        self.append(conversation_id, 'assistant', response_text)
+
+    def get_context(self, conversation_id: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """Rolling summary and the messages it does not cover yet (oldest first)"""
+        conversation = self._get_conversation(conversation_id)
+        if conversation is None:
+            return "", []
+
+        conversation.last_access = time.time()
+        self._conversations.move_to_end(conversation_id)
+
+        unsummarized = conversation.appended - conversation.summarized
+        messages = list(conversation.messages)[-unsummarized:] if unsummarized > 0 else []
+        return conversation.summary, [message.to_dict() for message in messages]
+
+    def pending_summary(self, conversation_id: str, keep_recent: int) -> Tuple[str, List[Dict[str, Any]], int]:
+        """Current summary, the unsummarized messages older than the last keep_recent, and the resulting coverage"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            return "", [], 0
+
+        target = max(conversation.appended - keep_recent, conversation.summarized)
+        messages = list(conversation.messages)
+        # Absolute index of messages[0] among all appended messages
+        first_index = conversation.appended - len(messages)
+        pending = [
+            message.to_dict()
+            for offset, message in enumerate(messages)
+            if conversation.summarized <= first_index + offset < target
+        ]
+        return conversation.summary, pending, target
+
+    def update_summary(self, conversation_id: str, summary: str, summarized: int) -> None:
+        """Replace the rolling summary of a conversation"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None or summarized < conversation.summarized:
+            return
+
+        self.total_bytes -= conversation.size_bytes
+        conversation.set_summary(summary, summarized)
+        self.total_bytes += conversation.size_bytes
+
+    def evict_expired(self) -> int:
+        """Drop conversations idle for longer than the TTL; returns how many were dropped"""
+        cutoff = time.time() - self.idle_ttl
+        expired = [cid for cid, conversation in self._conversations.items() if conversation.last_access < cutoff]
+
+        for conversation_id in expired:
+            # Expired conversations are dropped, not spilled
+            self._evict(conversation_id, spill=False)
+            self.expirations += 1
+
+        return len(expired)
+
+    async def load(self, conversation_id: str) -> None:
+        """Bring a spilled conversation back into memory (file I/O runs in a worker thread)"""
+        if conversation_id in self._conversations or not self.spill_dir:
+            return
+
+        async with self._get_io_lock():
+            if conversation_id in self._conversations:
+                return
+            record = self._pending_spills.pop(conversation_id, None)
+            if record is None:
+                record = await asyncio.to_thread(self._read_spill, conversation_id)
+            if record is not None and conversation_id not in self._conversations:
+                self._install(conversation_id, record)
+
+    async def sweep_spills(self) -> int:
+        """Delete spill files idle for longer than the TTL, then the oldest ones beyond the disk quota"""
+        if not self.spill_dir:
+            return 0
+        async with self._get_io_lock():
+            removed = await asyncio.to_thread(self._sweep_spill_files)
+        self.spill_expirations += removed
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get store statistics"""
+        return {
+            'conversations': len(self._conversations),
+            'total_bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'spilled': self.spilled,
+            'restored': self.restored,
+            'pending_spills': len(self._pending_spills),
+            'spill_expirations': self.spill_expirations
+        }
+
+    def _get_io_lock(self) -> asyncio.Lock:
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        return self._io_lock
+
+    def _get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        """In-memory conversation (an eviction still waiting to be written is taken back)"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None and conversation_id in self._pending_spills:
+            self._install(conversation_id, self._pending_spills.pop(conversation_id))
+            conversation = self._conversations.get(conversation_id)
+        return conversation
+
+    def _enforce_budget(self, keep: str) -> None:
+        """Evict least recently used conversations until within the byte budget"""
+        while self.total_bytes > self.max_bytes and len(self._conversations) > 1:
+            oldest_id = next(iter(self._conversations))
+            if oldest_id == keep:
+                break
+            self._evict(oldest_id)
+            self.evictions += 1
+
+    def _evict(self, conversation_id: str, spill: bool = True) -> None:
+        conversation = self._conversations.pop(conversation_id)
+        self.total_bytes -= conversation.size_bytes
+
+        if spill and self.spill_dir:
+            self._pending_spills[conversation_id] = {
+                'conversation_id': conversation_id,
+                'messages': [message.to_dict() for message in conversation.messages],
+                'summary': conversation.summary,
+                'appended': conversation.appended,
+                'summarized': conversation.summarized
+            }
+            self._schedule_spill()
+
+    def _schedule_spill(self) -> None:
+        """Write pending spills in the background (inline when there is no running event loop)"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            while self._pending_spills:
+                self._write_spill(*self._pending_spills.popitem())
+            return
+
+        if self._spill_task is None or self._spill_task.done():
+            self._spill_task = loop.create_task(self._flush_spills())
+
+    async def _flush_spills(self) -> None:
+        while self._pending_spills:
+            async with self._get_io_lock():
+                if not self._pending_spills:
+                    break
+                conversation_id, record = next(iter(self._pending_spills.items()))
+                await asyncio.to_thread(self._write_spill, conversation_id, record)
+                # A load() may have taken it back meanwhile; the file is then stale
+                if self._pending_spills.get(conversation_id) is record:
+                    del self._pending_spills[conversation_id]
+                else:
+                    await asyncio.to_thread(self._remove_spill, conversation_id)
+
+    def _spill_path(self, conversation_id: str) -> str:
+        digest = hashlib.sha256(conversation_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.json")
+
+    def _write_spill(self, conversation_id: str, record: Dict[str, Any]) -> None:
+        """Write an evicted conversation to disk"""
+        path = self._spill_path(conversation_id)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(record, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self.spilled += 1
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Could not spill conversation {conversation_id}: {e}")
+
+    def _remove_spill(self, conversation_id: str) -> None:
+        try:
+            os.remove(self._spill_path(conversation_id))
+        except OSError:
+            pass
+
+    def _read_spill(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Read and delete a spilled conversation"""
+        path = self._spill_path(conversation_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Unreadable spilled conversation {path}: {e}")
+            return None
+
+        if record.get('conversation_id') != conversation_id:
+            return None
+        return record
+
+    def _sweep_spill_files(self) -> int:
+        try:
+            files = [entry for entry in os.scandir(self.spill_dir) if entry.name.endswith('.json')]
+            files = [(entry.path, entry.stat()) for entry in files]
+        except OSError:
+            return 0
+
+        files.sort(key=lambda item: item[1].st_mtime)
+        cutoff = time.time() - self.idle_ttl
+        total = sum(stat.st_size for _, stat in files)
+        removed = 0
+
+        for path, stat in files:
+            if stat.st_mtime >= cutoff and total <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                total -= stat.st_size
+            except OSError:
+                pass
+        return removed
+
+    def _install(self, conversation_id: str, record: Dict[str, Any]) -> None:
+        """Rebuild a conversation from its spill record"""
+        conversation = Conversation(self.max_messages)
+        for message in record.get('messages', []):
+            conversation.append(ChatMessage(message['role'], message['content'], message.get('timestamp')))
+        conversation.appended = max(record.get('appended', 0), conversation.appended)
+        conversation.set_summary(record.get('summary', ""), record.get('summarized', 0))
+
+        self._conversations[conversation_id] = conversation
+        self.total_bytes += conversation.size_bytes
+        self.restored += 1
+        self._enforce_budget(keep=conversation_id)
@@ -1,12 +1,56 @@
+import os
 import re
+import json
+import math
+import hashlib
 import asyncio
 import logging
-from typing import Dict, List, Optional, Tuple, Any
-from datetime import datetime
-from models import FinanceResponse, TransactionData, FinanceInsightsResponse
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Any, AsyncIterator
+from datetime import datetime, date
+from models import FinanceResponse, TransactionData, FinanceInsightsResponse, SpendingAnomaly
+from cache_utils import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# Sentinel so that unparseable commands (None) can be cached too
+_CACHE_MISS = object()
+
+# Sentinel for "the caller did not parse the command" (None means it was unparseable)
+_NOT_PARSED = object()
+
+# Sentinel for blank NDJSON lines
+_EMPTY_LINE = object()
+
+# Period granularities aggregated together in a single pass
+PERIOD_GRANULARITIES = ('week', 'month', 'quarter', 'year')
+
+# Upper bound on the number of trailing buckets reported per granularity
+MAX_PERIOD_BUCKETS = int(os.getenv("FINANCE_MAX_PERIOD_BUCKETS", "520"))
+
+def _period_index(tx_date: date, period: str) -> int:
+    """Map a date to a contiguous integer index for the given period granularity"""
+    if period == 'week':
+        return (tx_date.toordinal() - 1) // 7  # Ordinal 1 (0001-01-01) is a Monday
+    if period == 'month':
+        return tx_date.year * 12 + tx_date.month - 1
+    if period == 'quarter':
+        return tx_date.year * 4 + (tx_date.month - 1) // 3
+    return tx_date.year
+
+def _period_label(index: int, period: str) -> str:
+    """Human readable key for a period index"""
+    if period == 'week':
+        iso_year, iso_week, _ = date.fromordinal(index * 7 + 1).isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    if period == 'month':
+        return f"{index // 12}-{index % 12 + 1:02d}"
+    if period == 'quarter':
+        return f"{index // 4}-Q{index % 4 + 1}"
+    return str(index)
+
 class FinanceCommandParser:
     """Parse natural language finance commands"""
     
@@ -34,6 +78,9 @@ class FinanceCommandParser:
             'shopping': ['mua sắm', 'quần áo', 'giày', 'túi', 'mỹ phẩm', 'đồ dùng'],
             'income': ['lương', 'thưởng', 'làm thêm', 'gia sư', 'freelance', 'bán hàng', 'thu nhập']
         }
+        
+        # Parsed commands cache (keyed on the normalized command)
+        self.parse_cache = LRUCache(int(os.getenv("FINANCE_PARSE_CACHE_SIZE", "2048")))
     
     def parse_amount(self, amount_str: str, unit: str = None) -> float:
         """Parse amount string with Vietnamese units"""
@@ -107,11 +154,45 @@ class FinanceCommandParser:
         
         return 'transaction'
 
+    def clean_command(self, command: str) -> str:
+        """NFC diacritics and collapsed whitespace (casing kept)"""
+        return ' '.join(unicodedata.normalize('NFC', command).split())
+    
+    def normalize_command(self, command: str) -> str:
+        """Normalize command for caching: NFC diacritics, lowercase, collapsed whitespace"""
+        return self.clean_command(command).lower()
+    
     def parse_command(self, command: str) -> Optional[TransactionData]:
-        """Parse a finance command into structured data"""
+        """Parse a finance command into structured data (memoized on the normalized command)"""
+        text = self.clean_command(command)
+        key = text.lower()
+        
+        transaction = self.parse_cache.get(key, _CACHE_MISS)
+        if transaction is _CACHE_MISS:
+            transaction = self._parse_clean_command(text)
+            self.parse_cache.set(key, transaction)
+        
+        return self._with_original_casing(transaction, text)
+    
+    def _with_original_casing(self, transaction: Optional[TransactionData], text: str) -> Optional[TransactionData]:
+        """Cached parses are shared by commands differing only in case; take the description's casing from this one"""
+        if transaction is None:
+            return None
+        
+        lowered = text.lower()
+        # Positions only line up when lowercasing keeps the length (true for Vietnamese text)
+        start = lowered.find(transaction.description.lower()) if len(lowered) == len(text) else -1
+        if start < 0:
+            return transaction
+        
+        description = text[start:start + len(transaction.description)]
+        if description == transaction.description:
+            return transaction
+        return transaction.model_copy(update={'description': description})
+    
+    def _parse_clean_command(self, command: str) -> Optional[TransactionData]:
+        """Parse a cleaned finance command (see clean_command)"""
         try:
-            command = command.strip()
-            
             # First check if this is a query command
             query_type = self.detect_query_type(command)
             if query_type != 'transaction':
@@ -199,6 +280,175 @@ class FinanceCommandParser:
         else:
             return f"✅ Đã lưu: chi **{formatted_amount} VNĐ** cho \"{transaction.description}\""
 
+class SpendingAggregator:
+    """Incrementally fold transactions into spending aggregates (constant memory per row)
+    
+    With a recurring_detector, rows are also grouped for recurring-payment detection, which keeps
+    a small record per positive-amount row.
+    """
+    
+    def __init__(self, recurring_detector: Optional["RecurringPaymentDetector"] = None):
+        self.recurring_detector = recurring_detector
+        self.recurring_groups: Dict[Tuple[str, str], List[Tuple[float, int, Dict[str, Any]]]] = {}
+        self.total_income = 0
+        self.total_expenses = 0
+        self.categories = {}
+        self.monthly_data = {}
+        self.period_buckets = {period: {} for period in PERIOD_GRANULARITIES}
+        self.transaction_count = 0
+    
+    def add(self, tx: Dict[str, Any]) -> None:
+        """Fold a single transaction into the aggregates"""
+        amount = float(tx.get('amount', 0))
+        tx_type = tx.get('type', 'expense')
+        category = tx.get('category', 'other')
+        date_str = tx.get('date', datetime.now().isoformat())
+        
+        try:
+            tx_date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        except:
+            tx_date = datetime.now()
+        month_key = tx_date.strftime('%Y-%m')
+        
+        self.transaction_count += 1
+        is_income = tx_type == 'income'
+        
+        # Week, month, quarter and year buckets in the same pass ([income, expenses])
+        for period, buckets in self.period_buckets.items():
+            bucket = buckets.setdefault(_period_index(tx_date.date(), period), [0, 0])
+            bucket[0 if is_income else 1] += amount
+        
+        if tx_type == 'income':
+            self.total_income += amount
+        else:
+            self.total_expenses += amount
+            
+            # Track by category
+            if category not in self.categories:
+                self.categories[category] = {'amount': 0, 'count': 0}
+            self.categories[category]['amount'] += amount
+            self.categories[category]['count'] += 1
+        
+        # Track monthly trends
+        if month_key not in self.monthly_data:
+            self.monthly_data[month_key] = {'income': 0, 'expenses': 0}
+        
+        if tx_type == 'income':
+            self.monthly_data[month_key]['income'] += amount
+        else:
+            self.monthly_data[month_key]['expenses'] += amount
+        
+        if self.recurring_detector is not None:
+            self.recurring_detector.add(self.recurring_groups, tx)
+    
+    def recurring_payments(self) -> List[Dict[str, Any]]:
+        """Recurring payments among the rows added so far (empty without a recurring_detector)"""
+        if self.recurring_detector is None:
+            return []
+        return self.recurring_detector.detect_groups(self.recurring_groups)
+    
+    def result(self) -> Dict[str, Any]:
+        """Build the analysis dict from the current aggregates"""
+        if not self.transaction_count:
+            return {'total_income': 0, 'total_expenses': 0, 'categories': {}, 'trends': {}}
+        
+        return {
+            'total_income': self.total_income,
+            'total_expenses': self.total_expenses,
+            'net_amount': self.total_income - self.total_expenses,
+            'categories': self.categories,
+            'monthly_trends': self.monthly_data,
+            'period_trends': {period: self._build_period_series(period) for period in PERIOD_GRANULARITIES},
+            'transaction_count': self.transaction_count
+        }
+    
+    def _build_period_series(self, period: str) -> List[Dict[str, Any]]:
+        """Contiguous period series with period-over-period deltas and rolling 3/12 averages"""
+        buckets = self.period_buckets[period]
+        if not buckets:
+            return []
+        
+        last_index = max(buckets)
+        first_index = max(min(buckets), last_index - MAX_PERIOD_BUCKETS + 1)
+        
+        series = []
+        incomes = []
+        expenses_list = []
+        for index in range(first_index, last_index + 1):
+            income, expenses = buckets.get(index, (0, 0))
+            incomes.append(income)
+            expenses_list.append(expenses)
+            
+            entry = {
+                'period': _period_label(index, period),
+                'income': income,
+                'expenses': expenses,
+                'net': income - expenses,
+                'income_change': None,
+                'expenses_change': None,
+                'expenses_change_pct': None,
+                'income_avg_3': sum(incomes[-3:]) / len(incomes[-3:]),
+                'expenses_avg_3': sum(expenses_list[-3:]) / len(expenses_list[-3:]),
+                'income_avg_12': sum(incomes[-12:]) / len(incomes[-12:]),
+                'expenses_avg_12': sum(expenses_list[-12:]) / len(expenses_list[-12:])
+            }
+            
+            if series:
+                previous = series[-1]
+                entry['income_change'] = income - previous['income']
+                entry['expenses_change'] = expenses - previous['expenses']
+                if previous['expenses'] > 0:
+                    entry['expenses_change_pct'] = (expenses - previous['expenses']) / previous['expenses'] * 100
+            
+            series.append(entry)
+        
+        return series
+
+async def iter_ndjson_rows(chunks: AsyncIterator[bytes], max_line_bytes: int = 65536) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """Decode an NDJSON byte stream row by row; yields None for malformed or oversized lines"""
+    buffer = b''
+    discarding = False
+    
+    async for chunk in chunks:
+        # Split once per chunk; only the trailing partial line is carried over
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        
+        for line in lines:
+            if discarding:
+                # Tail of an oversized line that was already reported
+                discarding = False
+                continue
+            
+            row = _decode_ndjson_line(line)
+            if row is not _EMPTY_LINE:
+                yield row
+        
+        # Never buffer more than one line's worth of data
+        if len(buffer) > max_line_bytes:
+            buffer = b''
+            if not discarding:
+                discarding = True
+                yield None
+    
+    if buffer and not discarding:
+        row = _decode_ndjson_line(buffer)
+        if row is not _EMPTY_LINE:
+            yield row
+
+def _decode_ndjson_line(line: bytes) -> Any:
+    """Decode one NDJSON line into a dict"""
+    line = line.strip()
+    if not line:
+        return _EMPTY_LINE
+    
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    
+    return row if isinstance(row, dict) else None
+
 class FinanceInsightsGenerator:
     """Generate financial insights and recommendations"""
     
@@ -207,54 +457,12 @@ class FinanceInsightsGenerator:
     
     def analyze_spending_patterns(self, transactions: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Analyze spending patterns from transaction data"""
-        if not transactions:
-            return {'total_income': 0, 'total_expenses': 0, 'categories': {}, 'trends': {}}
-        
-        total_income = 0
-        total_expenses = 0
-        categories = {}
-        monthly_data = {}
+        aggregator = SpendingAggregator()
         
         for tx in transactions:
-            amount = float(tx.get('amount', 0))
-            tx_type = tx.get('type', 'expense')
-            category = tx.get('category', 'other')
-            date_str = tx.get('date', datetime.now().isoformat())
-            
-            try:
-                tx_date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                month_key = tx_date.strftime('%Y-%m')
-            except:
-                month_key = datetime.now().strftime('%Y-%m')
-            
-            if tx_type == 'income':
-                total_income += amount
-            else:
-                total_expenses += amount
-                
-                # Track by category
-                if category not in categories:
-                    categories[category] = {'amount': 0, 'count': 0}
-                categories[category]['amount'] += amount
-                categories[category]['count'] += 1
-            
-            # Track monthly trends
-            if month_key not in monthly_data:
-                monthly_data[month_key] = {'income': 0, 'expenses': 0}
-            
-            if tx_type == 'income':
-                monthly_data[month_key]['income'] += amount
-            else:
-                monthly_data[month_key]['expenses'] += amount
+            aggregator.add(tx)
         
-        return {
-            'total_income': total_income,
-            'total_expenses': total_expenses,
-            'net_amount': total_income - total_expenses,
-            'categories': categories,
-            'monthly_trends': monthly_data,
-            'transaction_count': len(transactions)
-        }
+        return aggregator.result()
     
     def generate_insights(self, analysis: Dict[str, Any]) -> List[str]:
         """Generate insights based on financial analysis"""
@@ -273,6 +481,17 @@ class FinanceInsightsGenerator:
             savings_rate = (net_amount / total_income) * 100 if total_income > 0 else 0
             insights.append(f"✅ Bạn đã tiết kiệm được {net_amount:,.0f} VNĐ ({savings_rate:.1f}% thu nhập)")
         
+        # Latest period vs previous period for the selected granularity
+        period = analysis.get('period', 'month')
+        period_series = analysis.get('period_trends', {}).get(period, [])
+        if len(period_series) >= 2 and period_series[-1]['expenses_change_pct'] is not None:
+            change_pct = period_series[-1]['expenses_change_pct']
+            period_name = self._get_period_display_name(period)
+            if change_pct >= 10:
+                insights.append(f"📈 Chi tiêu {period_name} gần nhất tăng {change_pct:.1f}% so với {period_name} trước")
+            elif change_pct <= -10:
+                insights.append(f"📉 Chi tiêu {period_name} gần nhất giảm {abs(change_pct):.1f}% so với {period_name} trước")
+        
         # Top spending categories
         if categories:
             sorted_categories = sorted(categories.items(), key=lambda x: x[1]['amount'], reverse=True)
@@ -328,6 +547,16 @@ class FinanceInsightsGenerator:
         
         return recommendations[:3]  # Limit to 3 recommendations
     
+    def _get_period_display_name(self, period: str) -> str:
+        """Get display name for period"""
+        display_names = {
+            'week': 'tuần',
+            'month': 'tháng',
+            'quarter': 'quý',
+            'year': 'năm'
+        }
+        return display_names.get(period, period)
+    
     def _get_category_display_name(self, category: str) -> str:
         """Get display name for category"""
         display_names = {
@@ -343,31 +572,211 @@ class FinanceInsightsGenerator:
         }
         return display_names.get(category, category)
 
+class SpendingAnomalyDetector:
+    """Online per-user, per-category spending outlier detection"""
+    
+    # Per category slot: [count, mean, M2] of log(1 + amount) (Welford's algorithm)
+    SLOT_SIZE = 3
+    
+    def __init__(self, categories: List[str]):
+        self.category_slots = {category: index for index, category in enumerate(categories)}
+        self.max_users = int(os.getenv("FINANCE_ANOMALY_MAX_USERS", "10000"))
+        self.min_samples = int(os.getenv("FINANCE_ANOMALY_MIN_SAMPLES", "5"))
+        self.z_threshold = float(os.getenv("FINANCE_ANOMALY_Z_THRESHOLD", "3.0"))
+        self.min_std = 0.25  # Floor on log scale so near-constant spending doesn't flag tiny changes
+        
+        # user_id -> fixed-size array of slots, least recently active user evicted first
+        self.user_stats: "OrderedDict[str, array]" = OrderedDict()
+    
+    def _get_user_stats(self, user_id: str) -> array:
+        """Get (or create) the compact stats array for a user"""
+        stats = self.user_stats.get(user_id)
+        if stats is None:
+            stats = array('d', [0.0]) * (len(self.category_slots) * self.SLOT_SIZE)
+            self.user_stats[user_id] = stats
+            if len(self.user_stats) > self.max_users:
+                self.user_stats.popitem(last=False)
+        else:
+            self.user_stats.move_to_end(user_id)
+        return stats
+    
+    def observe(self, user_id: str, category: str, amount: float) -> Optional[SpendingAnomaly]:
+        """Score a new expense against the user's history for its category, then fold it in (O(1))"""
+        slot = self.category_slots.get(category, self.category_slots['other'])
+        stats = self._get_user_stats(user_id)
+        base = slot * self.SLOT_SIZE
+        count, mean, m2 = stats[base], stats[base + 1], stats[base + 2]
+        
+        value = math.log1p(amount)
+        anomaly = None
+        
+        if count >= self.min_samples:
+            std = max(math.sqrt(m2 / (count - 1)), self.min_std)
+            z_score = (value - mean) / std
+            if z_score >= self.z_threshold:
+                anomaly = SpendingAnomaly(
+                    category=category,
+                    amount=amount,
+                    typical_amount=math.expm1(mean),
+                    z_score=round(z_score, 2)
+                )
+        
+        # Welford update
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+        stats[base], stats[base + 1], stats[base + 2] = count, mean, m2
+        
+        return anomaly
+
+class RecurringPaymentDetector:
+    """Detect recurring commitments (subscriptions, rent, ...) in a transaction history in O(n log n)"""
+    
+    # Cadence name -> (expected interval in days, tolerance in days)
+    CADENCES = {
+        'weekly': (7.0, 2.0),
+        'monthly': (30.44, 4.0),
+        'quarterly': (91.31, 10.0),
+        'yearly': (365.25, 20.0)
+    }
+    
+    def __init__(self):
+        self.amount_tolerance = float(os.getenv("FINANCE_RECURRING_AMOUNT_TOLERANCE", "0.15"))
+        self.min_occurrences = int(os.getenv("FINANCE_RECURRING_MIN_OCCURRENCES", "3"))
+        self.min_regularity = 0.75  # Share of intervals that must match the cadence
+    
+    def normalize_description(self, description: str) -> str:
+        """Normalize description for grouping: NFC, lowercase, no digits/punctuation"""
+        description = unicodedata.normalize('NFC', description).lower()
+        description = re.sub(r'[\d\W_]+', ' ', description)
+        return ' '.join(description.split())
+    
+    def detect(self, transactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Find recurring payments and their next expected date"""
+        groups: Dict[Tuple[str, str], List[Tuple[float, int, Dict[str, Any]]]] = {}
+        for tx in transactions:
+            self.add(groups, tx)
+        return self.detect_groups(groups)
+    
+    def add(self, groups: Dict[Tuple[str, str], List[Tuple[float, int, Dict[str, Any]]]], tx: Dict[str, Any]) -> None:
+        """Hash pass: group a row by (type, normalized description), keeping only the fields detect_groups reports"""
+        try:
+            amount = float(tx.get('amount', 0))
+            day = datetime.fromisoformat(str(tx['date']).replace('Z', '+00:00')).date().toordinal()
+        except (KeyError, TypeError, ValueError):
+            return
+        if amount <= 0:
+            return
+        
+        tx_type = tx.get('type', 'expense')
+        key = self.normalize_description(str(tx.get('description') or '')) or str(tx.get('category', 'other'))
+        record = {'description': tx.get('description', ''), 'category': tx.get('category', 'other'), 'type': tx_type}
+        groups.setdefault((tx_type, key), []).append((amount, day, record))
+    
+    def detect_groups(self, groups: Dict[Tuple[str, str], List[Tuple[float, int, Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+        """Find recurring payments among rows grouped by add()"""
+        recurring = []
+        for rows in groups.values():
+            if len(rows) < self.min_occurrences:
+                continue
+            
+            # Sort pass: split each group into clusters of similar amounts (anchored on the cluster minimum)
+            rows.sort(key=lambda row: row[0])
+            cluster = [rows[0]]
+            for row in rows[1:]:
+                if row[0] <= cluster[0][0] * (1 + self.amount_tolerance):
+                    cluster.append(row)
+                else:
+                    self._collect_recurring(cluster, recurring)
+                    cluster = [row]
+            self._collect_recurring(cluster, recurring)
+        
+        recurring.sort(key=lambda item: item['next_expected_date'])
+        return recurring
+    
+    def _collect_recurring(self, cluster: List[Tuple[float, int, Dict[str, Any]]], recurring: List[Dict[str, Any]]) -> None:
+        """Check a cluster of similar payments for a periodic interval"""
+        if len(cluster) < self.min_occurrences:
+            return
+        
+        cluster.sort(key=lambda row: row[1])
+        intervals = [b[1] - a[1] for a, b in zip(cluster, cluster[1:])]
+        median_interval = sorted(intervals)[len(intervals) // 2]
+        
+        for cadence, (period_days, tolerance) in self.CADENCES.items():
+            if abs(median_interval - period_days) > tolerance:
+                continue
+            
+            matching = sum(1 for interval in intervals if abs(interval - period_days) <= tolerance)
+            regularity = matching / len(intervals)
+            if regularity < self.min_regularity:
+                return
+            
+            amounts = sorted(row[0] for row in cluster)
+            last_amount, last_day, last_tx = cluster[-1]
+            recurring.append({
+                'description': last_tx.get('description', ''),
+                'category': last_tx.get('category', 'other'),
+                'type': last_tx.get('type', 'expense'),
+                'amount': amounts[len(amounts) // 2],
+                'cadence': cadence,
+                'interval_days': median_interval,
+                'occurrences': len(cluster),
+                'last_date': date.fromordinal(last_day).isoformat(),
+                'next_expected_date': date.fromordinal(last_day + round(period_days)).isoformat(),
+                'confidence': round(regularity, 2)
+            })
+            return
+
 class FinanceAIService:
     """Main finance AI service"""
     
     def __init__(self):
         self.parser = FinanceCommandParser()
         self.insights_generator = FinanceInsightsGenerator()
+        self.recurring_detector = RecurringPaymentDetector()
+        self.anomaly_detector = SpendingAnomalyDetector(
+            list(self.parser.category_mapping.keys()) + ['blockchain', 'other']
+        )
         self.is_initialized = True
     
-    async def process_command(self, command: str) -> FinanceResponse:
-        """Process a finance command"""
+    async def process_command(
+        self,
+        command: str,
+        user_id: Optional[str] = None,
+        transaction: Any = _NOT_PARSED
+    ) -> FinanceResponse:
+        """Process a finance command (pass transaction when the caller already parsed it)"""
         try:
             logger.info(f"Processing finance command: {command}")
             
             # Parse the command
-            transaction = self.parser.parse_command(command)
+            if transaction is _NOT_PARSED:
+                transaction = self.parser.parse_command(command)
             
             if transaction:
                 # Generate response message
                 response_text = self.parser.generate_response(transaction)
                 
+                # Flag expenses that are unusual for this user and category
+                anomaly = None
+                if user_id and transaction.type == 'expense':
+                    anomaly = self.anomaly_detector.observe(user_id, transaction.category or 'other', transaction.amount)
+                    if anomaly:
+                        category_name = self.insights_generator._get_category_display_name(anomaly.category)
+                        anomaly.message = (
+                            f"⚠️ Khoản chi này cao bất thường so với mức {category_name} thường ngày của bạn "
+                            f"(~{anomaly.typical_amount:,.0f} VNĐ)"
+                        )
+                        response_text += f"\n\n{anomaly.message}"
+                
                 return FinanceResponse(
                     transaction=transaction,
                     response_text=response_text,
                     parsed_successfully=True,
-                    confidence=transaction.confidence
+                    confidence=transaction.confidence,
+                    anomaly=anomaly
                 )
             else:
                 # Command could not be parsed
@@ -397,38 +806,129 @@ class FinanceAIService:
             # Analyze spending patterns
             analysis = self.insights_generator.analyze_spending_patterns(transactions)
             
-            # Generate insights and recommendations
-            insights = self.insights_generator.generate_insights(analysis)
-            recommendations = self.insights_generator.generate_recommendations(analysis)
+            # Detect subscriptions, rent and other recurring commitments
+            recurring_payments = self.recurring_detector.detect(transactions)
             
-            # Create summary
-            total_income = analysis.get('total_income', 0)
-            total_expenses = analysis.get('total_expenses', 0)
-            net_amount = analysis.get('net_amount', 0)
+            return self._build_insights_response(analysis, period, recurring_payments)
             
-            if net_amount >= 0:
-                summary = f"Trong {period} này, bạn đã thu được {total_income:,.0f} VNĐ, chi tiêu {total_expenses:,.0f} VNĐ và tiết kiệm được {net_amount:,.0f} VNĐ."
-            else:
-                deficit = abs(net_amount)
-                summary = f"Trong {period} này, bạn đã thu được {total_income:,.0f} VNĐ, chi tiêu {total_expenses:,.0f} VNĐ và thâm hụt {deficit:,.0f} VNĐ."
+        except Exception as e:
+            logger.error(f"Error generating insights: {e}")
+            return self._insights_error_response(e)
+    
+    async def generate_insights_from_stream(self, rows: AsyncIterator[Optional[Dict[str, Any]]], period: str = "month") -> FinanceInsightsResponse:
+        """Generate insights from a row stream, folding rows into the aggregates as they arrive"""
+        try:
+            aggregator = SpendingAggregator(self.recurring_detector)
+            skipped_rows = 0
             
-            return FinanceInsightsResponse(
-                insights=insights,
-                recommendations=recommendations,
-                trends=analysis,
-                summary=summary
-            )
+            async for tx in rows:
+                if tx is None:
+                    skipped_rows += 1
+                    continue
+                
+                try:
+                    aggregator.add(tx)
+                except (TypeError, ValueError, AttributeError):
+                    skipped_rows += 1
+            
+            logger.info(f"Streamed {aggregator.transaction_count} transactions over {period} ({skipped_rows} skipped)")
+            
+            analysis = aggregator.result()
+            analysis['skipped_rows'] = skipped_rows
+            
+            return self._build_insights_response(analysis, period, aggregator.recurring_payments())
             
         except Exception as e:
-            logger.error(f"Error generating insights: {e}")
-            return FinanceInsightsResponse(
-                insights=["Không thể tạo insights do lỗi hệ thống"],
-                recommendations=["Vui lòng thử lại sau"],
-                trends={},
-                summary="Có lỗi xảy ra khi phân tích dữ liệu tài chính",
-                success=False,
-                message=f"Insights generation error: {str(e)}"
+            logger.error(f"Error generating streamed insights: {e}")
+            return self._insights_error_response(e)
+    
+    def _build_insights_response(self, analysis: Dict[str, Any], period: str, recurring_payments: Optional[List[Dict[str, Any]]] = None) -> FinanceInsightsResponse:
+        """Turn a spending analysis into insights, recommendations and a summary"""
+        recurring_payments = recurring_payments or []
+        
+        # All granularities are precomputed; the selected one drives the insights
+        analysis['period'] = period
+        
+        # Generate insights and recommendations
+        insights = self.insights_generator.generate_insights(analysis)
+        recommendations = self.insights_generator.generate_recommendations(analysis)
+        
+        recurring_expenses = [item for item in recurring_payments if item['type'] != 'income']
+        if recurring_expenses:
+            # Normalize every commitment to a monthly cost
+            monthly_cost = sum(
+                item['amount'] * RecurringPaymentDetector.CADENCES['monthly'][0] / RecurringPaymentDetector.CADENCES[item['cadence']][0]
+                for item in recurring_expenses
             )
+            insights.append(f"🔁 Bạn có {len(recurring_expenses)} khoản chi định kỳ, khoảng {monthly_cost:,.0f} VNĐ mỗi tháng")
+        
+        # Create summary
+        total_income = analysis.get('total_income', 0)
+        total_expenses = analysis.get('total_expenses', 0)
+        net_amount = analysis.get('net_amount', 0)
+        
+        if net_amount >= 0:
+            summary = f"Trong {period} này, bạn đã thu được {total_income:,.0f} VNĐ, chi tiêu {total_expenses:,.0f} VNĐ và tiết kiệm được {net_amount:,.0f} VNĐ."
+        else:
+            deficit = abs(net_amount)
+            summary = f"Trong {period} này, bạn đã thu được {total_income:,.0f} VNĐ, chi tiêu {total_expenses:,.0f} VNĐ và thâm hụt {deficit:,.0f} VNĐ."
+        
+        return FinanceInsightsResponse(
+            insights=insights,
+            recommendations=recommendations,
+            trends=analysis,
+            summary=summary,
+            recurring_payments=recurring_payments
+        )
+    
+    def _insights_error_response(self, error: Exception) -> FinanceInsightsResponse:
+        """Fallback response when insights generation fails"""
+        return FinanceInsightsResponse(
+            insights=["Không thể tạo insights do lỗi hệ thống"],
+            recommendations=["Vui lòng thử lại sau"],
+            trends={},
+            summary="Có lỗi xảy ra khi phân tích dữ liệu tài chính",
+            success=False,
+            message=f"Insights generation error: {str(error)}"
+        )
+
+def _quantize_amount(amount: Any, ratio: float) -> int:
+    """Log-scale bucket index so that amounts within ~ratio of each other share a bucket"""
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return 0
+    
+    bucket = round(math.log1p(abs(amount)) / math.log(ratio))
+    return bucket if amount >= 0 else -bucket
+
+def build_plan_fingerprint(financial_summary: Dict[str, Any], goal_type: str) -> str:
+    """Quantized fingerprint of a financial summary; near-identical profiles map to the same key"""
+    ratio = float(os.getenv("SMART_PLAN_BUCKET_RATIO", "1.15"))
+    
+    # Category mix as expense shares rounded to 10% steps (ignoring tiny categories)
+    category_breakdown = financial_summary.get('category_breakdown') or {}
+    amounts = {}
+    for category, amount in category_breakdown.items():
+        try:
+            amounts[category] = max(float(amount), 0.0)
+        except (TypeError, ValueError):
+            continue
+    total = sum(amounts.values())
+    category_mix = sorted(
+        (category, round(amount / total * 10))
+        for category, amount in amounts.items()
+        if total > 0 and amount / total >= 0.05
+    )
+    
+    fingerprint = [
+        goal_type,
+        _quantize_amount(financial_summary.get('total_income', 0), ratio),
+        _quantize_amount(financial_summary.get('total_expenses', 0), ratio),
+        _quantize_amount(financial_summary.get('net_amount', 0), ratio),
+        category_mix
+    ]
+    return hashlib.sha256(json.dumps(fingerprint, ensure_ascii=False).encode('utf-8')).hexdigest()
 
 class FinanceQueryGenerator:
     """Generate humorous and fun responses for finance queries"""
@@ -617,4 +1117,11 @@ class FinanceQueryGenerator:
 
 # Global service instance
 finance_service = FinanceAIService()
-query_generator = FinanceQueryGenerator()
\ No newline at end of file
+query_generator = FinanceQueryGenerator()
+
+# Smart plans cached per (goal_type, quantized financial profile)
+smart_plan_cache = LRUCache(
+    max_size=int(os.getenv("SMART_PLAN_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("SMART_PLAN_CACHE_TTL_SECONDS", "21600")),
+    disk_dir=os.getenv("SMART_PLAN_CACHE_DIR") or None
+)
\ No newline at end of file
@@ -0,0 +1,577 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import functools
+import dataclasses
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional
+
+# Import Google Generative AI
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while every provider's circuit breaker is open"""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker: closed -> open -> half-open trial -> closed"""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, name: str = "Gemini"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_success: Optional[float] = None
+        self.last_failure: Optional[float] = None
+        self._trial_in_flight = False
+
+    def is_available(self) -> bool:
+        """Whether allow_request would currently let a call through (does not change state)"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.time() - self.opened_at >= self.reset_timeout
+        return not self._trial_in_flight
+
+    def allow_request(self) -> bool:
+        """Whether a call may go out now (in half-open state only one trial call at a time)"""
+        if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._trial_in_flight = False
+
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """The call was abandoned without an outcome (e.g. a cancelled hedge)"""
+        self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info(f"✅ {self.name} circuit closed")
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.last_success = time.time()
+        self._trial_in_flight = False
+
+    def record_failure(self, error: BaseException) -> None:
+        self.consecutive_failures += 1
+        self.last_error = repr(error)
+        self.last_failure = time.time()
+        self._trial_in_flight = False
+
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"⚠️ {self.name} circuit opened after {self.consecutive_failures} failures: {self.last_error}")
+            self.state = "open"
+            self.opened_at = time.time()
+
+    def get_status(self) -> Dict[str, Any]:
+        """Breaker state for health reporting"""
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'last_error': self.last_error,
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'retry_in': max(self.reset_timeout - (time.time() - self.opened_at), 0.0) if self.state == "open" else None
+        }
+
+class BaseProvider(ABC):
+    """One model/key endpoint with its own circuit breaker and latency history"""
+
+    def __init__(self, name: str, model_name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.model_name = model_name
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, name=name)
+        self.latencies: Deque[float] = deque(maxlen=200)
+        self.stats = {'requests': 0, 'successes': 0, 'failures': 0, 'cancelled': 0, 'hedge_wins': 0}
+
+    def latency_percentile(self, percentile: float = 0.95, min_samples: int = 20) -> Optional[float]:
+        """Recent successful-call latency percentile (None until there are enough samples)"""
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * percentile), len(ordered) - 1)]
+
+    async def generate(self, prompt: str, generation_config: Any, timeout: float) -> str:
+        """Call the provider with breaker and latency accounting (caller already passed allow_request)"""
+        self.stats['requests'] += 1
+        start = time.monotonic()
+        try:
+            text = await asyncio.wait_for(self._generate(prompt, generation_config), timeout=timeout)
+        except asyncio.CancelledError:
+            self.stats['cancelled'] += 1
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.stats['failures'] += 1
+            self.breaker.record_failure(e)
+            raise
+
+        self.latencies.append(time.monotonic() - start)
+        self.stats['successes'] += 1
+        self.breaker.record_success()
+        return text
+
+    async def stream(self, prompt: str, generation_config: Any, deadline: float) -> AsyncIterator[str]:
+        """Stream text chunks with breaker accounting; the deadline (loop time) bounds the whole stream"""
+        self.stats['requests'] += 1
+        try:
+            async for text in self._stream(prompt, generation_config, deadline):
+                yield text
+        except Exception as e:
+            self.stats['failures'] += 1
+            self.breaker.record_failure(e)
+            raise
+        except BaseException:
+            self.stats['cancelled'] += 1
+            self.breaker.release()
+            raise
+
+        self.stats['successes'] += 1
+        self.breaker.record_success()
+
+    def get_model(self) -> Any:
+        return None
+
+    @abstractmethod
+    async def _generate(self, prompt: str, generation_config: Any) -> str:
+        """Return the full response text"""
+
+    @abstractmethod
+    def _stream(self, prompt: str, generation_config: Any, deadline: float) -> AsyncIterator[str]:
+        """Async generator of text chunks; the deadline (loop time) bounds the whole stream"""
+
+    def get_status(self) -> Dict[str, Any]:
+        p95 = self.latency_percentile()
+        return {
+            **self.breaker.get_status(),
+            'model': self.model_name,
+            'p95_latency': round(p95, 3) if p95 is not None else None,
+            **self.stats
+        }
+
+class GeminiProvider(BaseProvider):
+    """A Gemini model reached with one API key"""
+
+    def __init__(
+        self,
+        model_name: str,
+        api_key: str,
+        key_index: int,
+        get_executor: Callable[[], ThreadPoolExecutor],
+        **breaker_settings
+    ):
+        super().__init__(f"{model_name}#key{key_index + 1}", model_name, **breaker_settings)
+        self.api_key = api_key
+        self.key_index = key_index
+        self._get_executor = get_executor
+        self._model = None
+        self._service_client = None
+
+    def get_model(self) -> Any:
+        """Cached GenerativeModel (uses the process-wide key set by genai.configure)"""
+        if self._model is None:
+            self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    @property
+    def uses_own_key(self) -> bool:
+        """genai.configure is process-wide (first key); other keys call the service with their own client"""
+        return self.key_index > 0
+
+    def _get_service_client(self) -> Any:
+        """generativelanguage async client authenticated with this provider's key (needs a running loop)"""
+        if self._service_client is None:
+            from google.ai import generativelanguage as glm
+            self._service_client = glm.GenerativeServiceAsyncClient(client_options={'api_key': self.api_key})
+        return self._service_client
+
+    def _service_request(self, prompt: str, generation_config: Any) -> Any:
+        from google.ai import generativelanguage as glm
+
+        if dataclasses.is_dataclass(generation_config):
+            generation_config = dataclasses.asdict(generation_config)
+        settings = {key: value for key, value in (generation_config or {}).items() if value is not None}
+
+        return glm.GenerateContentRequest(
+            model=f"models/{self.model_name}",
+            contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+            generation_config=glm.GenerationConfig(**settings)
+        )
+
+    async def _generate(self, prompt: str, generation_config: Any) -> str:
+        if self.uses_own_key:
+            response = await self._get_service_client().generate_content(
+                request=self._service_request(prompt, generation_config)
+            )
+            return _response_text(response)
+
+        model = self.get_model()
+        if hasattr(model, 'generate_content_async'):
+            response = await model.generate_content_async(prompt, generation_config=generation_config)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(),
+                functools.partial(model.generate_content, prompt, generation_config=generation_config)
+            )
+        return response.text if response else ""
+
+    async def _stream(self, prompt: str, generation_config: Any, deadline: float) -> AsyncIterator[str]:
+        model = self.get_model()
+        loop = asyncio.get_running_loop()
+
+        def remaining() -> float:
+            left = deadline - loop.time()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            return left
+
+        if self.uses_own_key:
+            responses = await asyncio.wait_for(
+                self._get_service_client().stream_generate_content(
+                    request=self._service_request(prompt, generation_config)
+                ),
+                timeout=remaining()
+            )
+            chunks = responses.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining())
+                except StopAsyncIteration:
+                    break
+                text = _response_text(chunk)
+                if text:
+                    yield text
+            return
+
+        if hasattr(model, 'generate_content_async'):
+            response = await asyncio.wait_for(
+                model.generate_content_async(prompt, generation_config=generation_config, stream=True),
+                timeout=remaining()
+            )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining())
+                except StopAsyncIteration:
+                    break
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
+            return
+
+        # Synchronous SDK: iterate the stream on a worker thread and hand chunks over through a queue
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def produce() -> None:
+            try:
+                for chunk in model.generate_content(prompt, generation_config=generation_config, stream=True):
+                    loop.call_soon_threadsafe(queue.put_nowait, ('chunk', _chunk_text(chunk)))
+                loop.call_soon_threadsafe(queue.put_nowait, ('done', None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, ('error', e))
+
+        self._get_executor().submit(produce)
+
+        while True:
+            kind, payload = await asyncio.wait_for(queue.get(), timeout=remaining())
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise payload
+            if payload:
+                yield payload
+
+class LocalStubProvider(BaseProvider):
+    """Offline provider for local development and tests: echoes the prompt after a configurable delay"""
+
+    def __init__(
+        self,
+        name: str = "local-stub",
+        latency: float = 0.05,
+        failure_rate: float = 0.0,
+        reply: Optional[str] = None,
+        **breaker_settings
+    ):
+        super().__init__(name, name, **breaker_settings)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reply = reply
+
+    def _reply(self, prompt: str) -> str:
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError(f"{self.name} simulated failure")
+        return self.reply if self.reply is not None else f"[{self.name}] {prompt[-200:]}"
+
+    async def _generate(self, prompt: str, generation_config: Any) -> str:
+        await asyncio.sleep(self.latency)
+        return self._reply(prompt)
+
+    async def _stream(self, prompt: str, generation_config: Any, deadline: float) -> AsyncIterator[str]:
+        words = self._reply(prompt).split(' ')
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield word if i == len(words) - 1 else word + ' '
+
+class GeminiClient:
+    """Shared Gemini router: several model/key providers, per-provider circuit breakers and hedged requests"""
+
+    def __init__(self, api_key: str = None, providers: Optional[List[BaseProvider]] = None):
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY")
+        self.default_model_name = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-exp")
+        self.default_timeout = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+        self.max_workers = int(os.getenv("GEMINI_MAX_WORKERS", "8"))
+
+        # Extra models/keys to route across (comma separated, in order of preference)
+        self.model_names = _split_env("GEMINI_MODEL_NAMES") or [self.default_model_name]
+        self.api_keys = _split_env("GOOGLE_API_KEYS")
+        self.use_stub = os.getenv("GEMINI_USE_STUB", "False").lower() == "true"
+
+        # Hedging: ask the next provider once the current one is slower than its p95 latency
+        self.hedging_enabled = os.getenv("GEMINI_HEDGING", "True").lower() == "true"
+        self.hedge_default_delay = float(os.getenv("GEMINI_HEDGE_DELAY_SECONDS", "3"))
+        self.hedge_min_delay = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+        self.breaker_settings = {
+            'failure_threshold': int(os.getenv("GEMINI_BREAKER_FAILURES", "3")),
+            'reset_timeout': float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30"))
+        }
+        self.reset_timeout = self.breaker_settings['reset_timeout']
+
+        self._providers: Optional[List[BaseProvider]] = providers
+        self._configured = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.stats = {'requests': 0, 'hedged': 0, 'failovers': 0, 'exhausted': 0}
+
+    def configure(self) -> None:
+        """Configure the Gemini SDK (only once per process)"""
+        if self._configured:
+            return
+
+        keys = self.api_keys or [self.api_key]
+        if not keys[0]:
+            raise ValueError("GOOGLE_API_KEY not found")
+
+        genai.configure(api_key=keys[0])
+        self._configured = True
+        logger.info(f"🔑 Gemini API configured ({len(keys)} key(s), {len(self.model_names)} model(s))")
+
+    @property
+    def providers(self) -> List[BaseProvider]:
+        """Providers in order of preference (built on first use)"""
+        if self._providers is None:
+            if self.use_stub:
+                self._providers = [LocalStubProvider(**self.breaker_settings)]
+                logger.info("🧪 Using the local stub Gemini provider")
+            else:
+                self.configure()
+                keys = self.api_keys or [self.api_key]
+                self._providers = [
+                    GeminiProvider(model_name, key, index, self._get_executor, **self.breaker_settings)
+                    for model_name in self.model_names
+                    for index, key in enumerate(keys)
+                ]
+        return self._providers
+
+    @property
+    def state(self) -> str:
+        """Aggregate breaker state: closed if any provider is closed, open if none can be tried"""
+        if any(provider.breaker.state == "closed" for provider in self.providers):
+            return "closed"
+        if any(provider.breaker.is_available() for provider in self.providers):
+            return "half_open"
+        return "open"
+
+    def get_model(self, model_name: str = None) -> Any:
+        """Model object of the preferred provider for model_name"""
+        return self._ordered_providers(model_name)[0].get_model()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Bounded thread pool for SDKs without an async API"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gemini")
+        return self._executor
+
+    def _ordered_providers(self, model_name: Optional[str]) -> List[BaseProvider]:
+        """Providers serving model_name first, then the others as fallbacks"""
+        providers = self.providers
+        if not model_name:
+            return list(providers)
+        return [p for p in providers if p.model_name == model_name] + [p for p in providers if p.model_name != model_name]
+
+    def _hedge_delay(self, provider: BaseProvider) -> float:
+        p95 = provider.latency_percentile()
+        return max(p95 if p95 is not None else self.hedge_default_delay, self.hedge_min_delay)
+
+    async def generate(
+        self,
+        prompt: str,
+        generation_config: Any = None,
+        model_name: str = None,
+        timeout: float = None
+    ) -> str:
+        """Return the first successful answer; hedge to the next provider past p95 latency, fail over on errors"""
+        self.stats['requests'] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.default_timeout)
+        candidates = [p for p in self._ordered_providers(model_name) if p.breaker.is_available()]
+        pending: Dict[asyncio.Task, BaseProvider] = {}
+        hedge_task: Optional[asyncio.Task] = None
+        last_error: Optional[BaseException] = None
+
+        def launch() -> Optional[asyncio.Task]:
+            while candidates:
+                provider = candidates.pop(0)
+                if provider.breaker.allow_request():
+                    task = asyncio.ensure_future(
+                        provider.generate(prompt, generation_config, max(deadline - loop.time(), 0.01))
+                    )
+                    pending[task] = provider
+                    return task
+            return None
+
+        if launch() is None:
+            self.stats['exhausted'] += 1
+            raise CircuitOpenError("All Gemini providers are unavailable (circuit open)")
+
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+
+                # Only one hedge per call
+                can_hedge = self.hedging_enabled and hedge_task is None and candidates
+                wait = min(remaining, self._hedge_delay(next(iter(pending.values())))) if can_hedge else remaining
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if can_hedge:
+                        hedge_task = launch()
+                        if hedge_task is not None:
+                            self.stats['hedged'] += 1
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if task is hedge_task:
+                            provider.stats['hedge_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"⚠️ {provider.name} failed: {last_error!r}")
+
+                # Fail over once nothing is left in flight
+                if not pending and launch() is not None:
+                    self.stats['failovers'] += 1
+        finally:
+            for task in pending:
+                task.cancel()
+
+        self.stats['exhausted'] += 1
+        raise last_error or CircuitOpenError("All Gemini providers are unavailable (circuit open)")
+
+    async def stream(
+        self,
+        prompt: str,
+        generation_config: Any = None,
+        model_name: str = None,
+        timeout: float = None
+    ) -> AsyncIterator[str]:
+        """Stream response text chunks; fails over to the next provider if one fails before its first chunk"""
+        self.stats['requests'] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.default_timeout)
+        last_error: Optional[BaseException] = None
+
+        for provider in self._ordered_providers(model_name):
+            if not provider.breaker.allow_request():
+                continue
+
+            emitted = False
+            try:
+                async for text in provider.stream(prompt, generation_config, deadline):
+                    emitted = True
+                    yield text
+                return
+            except Exception as e:
+                if emitted:
+                    raise
+                last_error = e
+                self.stats['failovers'] += 1
+                logger.warning(f"⚠️ {provider.name} stream failed: {e!r}")
+
+        self.stats['exhausted'] += 1
+        raise last_error or CircuitOpenError("All Gemini providers are unavailable (circuit open)")
+
+    async def probe(self, model_name: str = None, timeout: float = None) -> bool:
+        """Minimal connectivity check of every provider that may be tried; True if any answered (never raises)"""
+        async def probe_one(provider: BaseProvider) -> bool:
+            if not provider.breaker.allow_request():
+                return False
+            try:
+                await provider.generate("ping", {'max_output_tokens': 1}, timeout or self.default_timeout)
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ Gemini probe of {provider.name} failed: {e!r}")
+                return False
+
+        try:
+            results = await asyncio.gather(*(probe_one(p) for p in self._ordered_providers(model_name)))
+        except Exception as e:
+            logger.warning(f"⚠️ Gemini probe failed: {e!r}")
+            return False
+        return any(results)
+
+    def get_status(self) -> Dict[str, Any]:
+        """Router and per-provider health"""
+        try:
+            providers = {provider.name: provider.get_status() for provider in self.providers}
+            state = self.state
+        except Exception as e:
+            return {'state': 'unconfigured', 'error': str(e), 'providers': {}}
+
+        return {'state': state, 'hedging': self.hedging_enabled, **self.stats, 'providers': providers}
+
+    def shutdown(self) -> None:
+        """Release the worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+def _split_env(name: str) -> List[str]:
+    return [value.strip() for value in os.getenv(name, "").split(",") if value.strip()]
+
+def _response_text(response: Any) -> str:
+    """Text of a generativelanguage GenerateContentResponse (first candidate)"""
+    if not response.candidates:
+        return ""
+    return "".join(part.text for part in response.candidates[0].content.parts)
+
+def _chunk_text(chunk: Any) -> str:
+    """Text of a streamed chunk (chunks without text parts, e.g. safety stops, yield '')"""
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+# Global client instance
+gemini_client = GeminiClient()
@@ -1,18 +1,26 @@
 import os
 import gc
 import time
+import asyncio
 import base64
+import json
+import random
+import hashlib
 import logging
 import numpy as np
 from io import BytesIO
+from contextlib import nullcontext
 from PIL import Image
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Callable
 import torch
 import imageio
 from datetime import datetime
 
 from model_manager import model_manager, force_clear_gpu_memory, get_gpu_memory_info
+from job_queue import AffinityScheduler, GenerationJob
+from cache_utils import BlobCache, LRUCache
 from models import (
+    ImageOutputOptions,
     GenerativeArtRequest, GenerativeArtResponse,
     GenerativeVideoRequest, GenerativeVideoResponse, 
     StreamingGenerativeRequest, StreamingGenerativeResponse
@@ -20,18 +28,189 @@ from models import (
 
 logger = logging.getLogger(__name__)
 
+# File extension of each output format
+IMAGE_EXTENSIONS = {'png': 'png', 'webp': 'webp', 'jpeg': 'jpg'}
+
+# Linear projection of Stable Diffusion 1.x latent channels to RGB (cheap approximate decode for previews)
+SD15_LATENT_RGB_FACTORS = [
+    #   R        G        B
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+def latents_to_preview(latents) -> Image.Image:
+    """Approximate RGB image (at latent resolution) of the first latent in a batch"""
+    factors = torch.tensor(SD15_LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum('chw,cr->hwr', latents[0].float(), factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8)
+    return Image.fromarray(rgb.cpu().numpy())
+
 class GenerativeService:
     """Service for handling all generative AI operations"""
     
     def __init__(self):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.images_dir = os.path.abspath(os.getenv('GENERATED_IMAGES_DIR', 'images'))
+        # Images delivered by URL, stored under their filename with a disk quota (least recently written go first)
+        self.image_store = BlobCache(
+            self.images_dir,
+            max_bytes=int(float(os.getenv('GENERATED_IMAGES_MAX_MB', '512')) * 1024 * 1024),
+            suffix=''
+        )
+        # Seeded generations are deterministic, so their encoded output is cached by content address
+        self.generation_cache = BlobCache(
+            os.getenv('GENERATION_CACHE_DIR', 'generation_cache'),
+            max_bytes=int(float(os.getenv('GENERATION_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+        )
+        # Text-encoder outputs for repeated prompt strings, keyed by (model id, full text) and kept on the CPU
+        # so they do not pin VRAM. Hits are the constant negative prompt and exact repeats of a whole prompt
+        self.embedding_cache_size = int(os.getenv('PROMPT_EMBED_CACHE_SIZE', '256'))
+        self.embedding_cache = LRUCache(max(1, self.embedding_cache_size))
         
-    def _image_to_base64(self, image: Image.Image) -> str:
-        """Convert PIL Image to base64 string"""
+    def _encode_image(self, image: Image.Image, output_format: str = "png", quality: int = 85) -> bytes:
+        """Encode a PIL Image as PNG, WebP or JPEG"""
         buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return img_str
+        if output_format == "jpeg":
+            image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True)
+        elif output_format == "webp":
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(buffer, format="PNG")
+        return buffer.getvalue()
+    
+    def _write_image_file(self, data: bytes, output_format: str) -> str:
+        """Store encoded image bytes under their content hash and return the filename"""
+        filename = f"{hashlib.sha256(data).hexdigest()}.{IMAGE_EXTENSIONS[output_format]}"
+        # Rewriting identical bytes also makes them the most recently used, so a URL just handed out is not evicted next
+        self.image_store.set(filename, data)
+        return filename
+    
+    def _package_bytes(self, data: bytes, options: ImageOutputOptions) -> Dict[str, str]:
+        """Deliver encoded image bytes inline (base64) or as a content-addressed /images URL"""
+        media_type = f"image/{options.output_format}"
+        
+        if options.delivery == "url":
+            filename = self._write_image_file(data, options.output_format)
+            return {'image_base64': "", 'image_url': f"/images/{filename}", 'media_type': media_type}
+        
+        return {'image_base64': base64.b64encode(data).decode("utf-8"), 'image_url': "", 'media_type': media_type}
+    
+    def _package_image(self, image: Image.Image, options: ImageOutputOptions, cache_key: str = None) -> Dict[str, str]:
+        """Encode and deliver an image, storing the encoded bytes in the generation cache"""
+        data = self._encode_image(image, options.output_format, options.quality)
+        if cache_key:
+            self.generation_cache.set(cache_key, data)
+        return self._package_bytes(data, options)
+    
+    async def _deliver_image(self, image: Image.Image, options: ImageOutputOptions, cache_key: str = None) -> Dict[str, str]:
+        """Encode and deliver an image off the event loop"""
+        return await asyncio.to_thread(self._package_image, image, options, cache_key)
+    
+    def _generation_key(self, model_type: str, request: ImageOutputOptions, seed: int, prompts: Dict[str, str]) -> str:
+        """Content address of a seeded generation: model, exact pipeline prompts, parameters, seed and encoding"""
+        payload = {
+            'model_id': model_manager.model_configs[model_type]['model_id'],
+            'prompts': prompts,
+            'num_inference_steps': request.num_inference_steps,
+            'guidance_scale': request.guidance_scale,
+            'width': request.width,
+            'height': request.height,
+            'seed': seed,
+            'output_format': request.output_format,
+            'quality': request.quality
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def _art_prompts(self, request: GenerativeArtRequest) -> Dict[str, str]:
+        return {
+            'prompt': self._create_enhanced_prompt(request.prompt, "art"),
+            'negative_prompt': self._get_negative_prompt("art")
+        }
+    
+    def _cache_key(self, model_type: str, request: ImageOutputOptions, seed: int) -> str:
+        prompts = self._art_prompts(request) if model_type == 'generative_art' else {'prompt': request.prompt}
+        return self._generation_key(model_type, request, seed, prompts)
+    
+    def _generator(self, seed: int):
+        return torch.Generator(device=self.device).manual_seed(seed)
+    
+    def _text_embeddings(self, model_type: str, pipe, text: str) -> tuple:
+        """Text-encoder output for one prompt string, from the embedding cache when possible
+        
+        The whole string is the key: CLIP encodes every token in the context of the others (and pads to a
+        fixed length), so a shared suffix cannot be encoded once and joined onto different prompts.
+        """
+        device = getattr(pipe, '_execution_device', self.device)
+        key = (model_manager.model_configs[model_type]['model_id'], text)
+        
+        cached = self.embedding_cache.get(key)
+        if cached is None:
+            with torch.no_grad():
+                if model_type == 'streaming_generative':
+                    # SDXL: per-token embeddings plus the pooled embedding (no CFG at turbo guidance)
+                    embeds, _, pooled, _ = pipe.encode_prompt(
+                        prompt=text, device=device, num_images_per_prompt=1, do_classifier_free_guidance=False
+                    )
+                    cached = (embeds.cpu(), pooled.cpu())
+                else:
+                    embeds, _ = pipe.encode_prompt(text, device, 1, False)
+                    cached = (embeds.cpu(),)
+            self.embedding_cache.set(key, cached)
+        
+        return tuple(tensor.to(device) for tensor in cached)
+    
+    def _use_embedding_cache(self, pipe) -> bool:
+        return self.embedding_cache_size > 0 and hasattr(pipe, 'encode_prompt')
+    
+    def _art_prompt_kwargs(self, pipe, prompts: Dict[str, str]) -> Dict[str, Any]:
+        """Pipeline prompt arguments for art: precomputed embeddings, or the raw strings
+        
+        The negative prompt is the same for every request, so it is encoded once; the style-enhanced
+        prompt embeds the user's text, so it only hits when that exact prompt is repeated.
+        """
+        if not self._use_embedding_cache(pipe):
+            return dict(prompts)
+        
+        prompt_embeds, = self._text_embeddings('generative_art', pipe, prompts['prompt'])
+        negative_prompt_embeds, = self._text_embeddings('generative_art', pipe, prompts['negative_prompt'])
+        return {'prompt_embeds': prompt_embeds, 'negative_prompt_embeds': negative_prompt_embeds}
+    
+    def _streaming_prompt_kwargs(self, pipe, prompts: List[str]) -> Dict[str, Any]:
+        """Pipeline prompt arguments for a streaming batch: stacked cached embeddings, or the raw strings"""
+        if not self._use_embedding_cache(pipe):
+            return {'prompt': prompts}
+        
+        embeddings = [self._text_embeddings('streaming_generative', pipe, prompt) for prompt in prompts]
+        return {
+            'prompt_embeds': torch.cat([embeds for embeds, _ in embeddings]),
+            'pooled_prompt_embeds': torch.cat([pooled for _, pooled in embeddings])
+        }
+    
+    async def lookup_cached(self, model_type: str, request: ImageOutputOptions):
+        """Cached response for a seeded art/streaming request (no model is loaded), or None
+        
+        Called once per request, by the endpoint before queueing, so cache stats count each request once.
+        """
+        if request.seed is None:
+            return None
+        
+        start_time = time.time()
+        data = await asyncio.to_thread(self.generation_cache.get, self._cache_key(model_type, request, request.seed))
+        if data is None:
+            return None
+        
+        delivered = await asyncio.to_thread(self._package_bytes, data, request)
+        response_class = GenerativeArtResponse if model_type == 'generative_art' else StreamingGenerativeResponse
+        return response_class(
+            **delivered,
+            prompt_used=request.prompt,
+            processing_time=time.time() - start_time,
+            model_used=model_manager.model_configs[model_type]['model_id'],
+            seed=request.seed,
+            cached=True
+        )
     
     def _save_video_file(self, frames, fps: int = 5) -> str:
         """Save video frames to MP4 file and return filename"""
@@ -94,8 +273,18 @@ class GenerativeService:
             )
         return "low quality, blurry, distorted"
     
-    async def generate_art(self, request: GenerativeArtRequest) -> GenerativeArtResponse:
-        """Generate art using prompthero/openjourney model"""
+    def _encode_preview(self, latents) -> str:
+        """Low-resolution JPEG preview of in-progress latents, base64 encoded"""
+        return base64.b64encode(self._encode_image(latents_to_preview(latents), "jpeg", 70)).decode("utf-8")
+    
+    async def generate_art(
+        self,
+        request: GenerativeArtRequest,
+        progress_callback: Optional[Callable[[int], None]] = None,
+        preview_callback: Optional[Callable[[int, str], None]] = None,
+        preview_every: int = 5
+    ) -> GenerativeArtResponse:
+        """Generate art using prompthero/openjourney model (previews are called with the step and a base64 JPEG)"""
         start_time = time.time()
         
         try:
@@ -115,8 +304,8 @@ class GenerativeService:
                 raise Exception("Generative art model not available")
             
             # Prepare prompts
-            enhanced_prompt = self._create_enhanced_prompt(request.prompt, "art")
-            negative_prompt = self._get_negative_prompt("art")
+            prompts = self._art_prompts(request)
+            seed = request.seed if request.seed is not None else random.randrange(2**32)
             
             logger.info(f"🎨 Generating art with prompt: {request.prompt}")
             
@@ -124,27 +313,36 @@ class GenerativeService:
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             
-            # Generate image
-            try:
-                if self.device == "cuda":
-                    with torch.autocast("cuda"):
-                        result = pipe(
-                            prompt=enhanced_prompt,
-                            negative_prompt=negative_prompt,
-                            num_inference_steps=request.num_inference_steps,
-                            guidance_scale=request.guidance_scale,
-                            width=request.width,
-                            height=request.height
-                        )
-                else:
-                    result = pipe(
-                        prompt=enhanced_prompt,
-                        negative_prompt=negative_prompt,
+            def on_step_end(pipeline, step, timestep, callback_kwargs):
+                if progress_callback is not None:
+                    progress_callback(step + 1)
+                # Runs on the pipeline thread; the final step is delivered as the full image instead
+                if preview_callback is not None and (step + 1) % preview_every == 0 and step + 1 < request.num_inference_steps:
+                    try:
+                        preview_callback(step + 1, self._encode_preview(callback_kwargs['latents']))
+                    except Exception as e:
+                        logger.warning(f"⚠️ Art preview failed at step {step + 1}: {e}")
+                return callback_kwargs
+            
+            def run_pipeline():
+                # autocast state is thread-local, so enter it on the worker thread
+                with torch.autocast("cuda") if self.device == "cuda" else nullcontext():
+                    return pipe(
+                        **self._art_prompt_kwargs(pipe, prompts),
                         num_inference_steps=request.num_inference_steps,
                         guidance_scale=request.guidance_scale,
                         width=request.width,
-                        height=request.height
+                        height=request.height,
+                        generator=self._generator(seed),
+                        callback_on_step_end=on_step_end,
+                        callback_on_step_end_tensor_inputs=['latents']
                     )
+            
+            # Generate image (off the event loop)
+            try:
+                # In use: /models endpoints must not evict or park the pipeline while the thread runs it
+                with model_manager.using('generative_art'):
+                    result = await asyncio.to_thread(run_pipeline)
                 
                 image = result.images[0]
                 
@@ -158,8 +356,9 @@ class GenerativeService:
                 force_clear_gpu_memory()
                 raise Exception("GPU out of memory during generation. Try reducing image size or num_inference_steps.")
             
-            # Convert to base64
-            image_base64 = self._image_to_base64(image)
+            # Encode in the requested format (only explicitly seeded output can ever be looked up again)
+            cache_key = self._generation_key('generative_art', request, seed, prompts) if request.seed is not None else None
+            delivered = await self._deliver_image(image, request, cache_key)
             
             # Clear image from memory
             del image
@@ -172,10 +371,11 @@ class GenerativeService:
             logger.info(f"📊 Final: {final_memory}")
             
             return GenerativeArtResponse(
-                image_base64=image_base64,
+                **delivered,
                 prompt_used=request.prompt,
                 processing_time=processing_time,
-                model_used="prompthero/openjourney"
+                model_used="prompthero/openjourney",
+                seed=seed
             )
             
         except Exception as e:
@@ -191,8 +391,12 @@ class GenerativeService:
                 processing_time=time.time() - start_time
             )
     
-    async def generate_video(self, request: GenerativeVideoRequest) -> GenerativeVideoResponse:
-        """Generate video using AnimateDiff-Lightning model"""
+    async def generate_video(
+        self,
+        request: GenerativeVideoRequest,
+        progress_callback: Optional[Callable[[int], None]] = None
+    ) -> GenerativeVideoResponse:
+        """Generate video using AnimateDiff-Lightning model (pipeline and encoding run off the event loop)"""
         start_time = time.time()
         
         try:
@@ -211,21 +415,29 @@ class GenerativeService:
             
             logger.info(f"🎬 Generating video with prompt: {request.prompt}")
             
+            def on_step_end(pipeline, step, timestep, callback_kwargs):
+                if progress_callback is not None:
+                    progress_callback(step + 1)
+                return callback_kwargs
+            
             # Generate video frames
-            output = pipe(
-                prompt=enhanced_prompt,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                num_frames=request.num_frames,
-                width=request.width,
-                height=request.height
-            )
+            with model_manager.using('generative_video'):
+                output = await asyncio.to_thread(
+                    pipe,
+                    prompt=enhanced_prompt,
+                    guidance_scale=request.guidance_scale,
+                    num_inference_steps=request.num_inference_steps,
+                    num_frames=request.num_frames,
+                    width=request.width,
+                    height=request.height,
+                    callback_on_step_end=on_step_end
+                )
             
             frames = output.frames[0]
             fps = 5  # Standard FPS for generated videos
             
             # Save video file
-            video_filename = self._save_video_file(frames, fps)
+            video_filename = await asyncio.to_thread(self._save_video_file, frames, fps)
             
             processing_time = time.time() - start_time
             logger.info(f"✅ Video generated in {processing_time:.2f}s")
@@ -250,8 +462,34 @@ class GenerativeService:
                 num_frames=request.num_frames
             )
     
+    def _run_streaming_pipeline(
+        self,
+        pipe,
+        requests: List[StreamingGenerativeRequest],
+        seeds: Optional[List[int]] = None
+    ) -> List[Image.Image]:
+        """Run one batched SDXL-Turbo call for requests sharing size, steps and guidance"""
+        first = requests[0]
+        result = pipe(
+            **self._streaming_prompt_kwargs(pipe, [request.prompt for request in requests]),
+            num_inference_steps=first.num_inference_steps,
+            guidance_scale=first.guidance_scale,
+            width=first.width,
+            height=first.height,
+            # One generator per image so each result depends only on its own seed
+            generator=[self._generator(seed) for seed in seeds] if seeds else None
+        )
+        return list(result.images)
+    
     async def generate_streaming(self, request: StreamingGenerativeRequest) -> StreamingGenerativeResponse:
         """Generate image using SDXL-Turbo for streaming (fast generation)"""
+        return (await self.generate_streaming_batch([request]))[0]
+    
+    async def generate_streaming_batch(
+        self,
+        requests: List[StreamingGenerativeRequest]
+    ) -> List[StreamingGenerativeResponse]:
+        """Generate several streaming images in one pipeline call (requests must share streaming_batch_key)"""
         start_time = time.time()
         
         try:
@@ -269,60 +507,106 @@ class GenerativeService:
             if not pipe:
                 raise Exception("Streaming generative model not available")
             
-            logger.info(f"⚡ Generating streaming image with prompt: {request.prompt}")
+            logger.info(f"⚡ Generating {len(requests)} streaming image(s) with prompt: {requests[0].prompt}")
             
-            # Generate image (fast generation with minimal steps)
+            # Generate images (fast generation with minimal steps, off the event loop)
             try:
-                result = pipe(
-                    prompt=request.prompt,
-                    num_inference_steps=request.num_inference_steps,
-                    guidance_scale=request.guidance_scale,
-                    width=request.width,
-                    height=request.height
-                )
-                
-                image = result.images[0]
-                
-                # Quick cleanup for streaming
-                del result
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+                seeds = [request.seed if request.seed is not None else random.randrange(2**32) for request in requests]
+                with model_manager.using('streaming_generative'):
+                    images = await asyncio.to_thread(self._run_streaming_pipeline, pipe, requests, seeds)
                 
             except torch.cuda.OutOfMemoryError as e:
                 logger.error(f"🔥 CUDA OOM during streaming generation: {e}")
                 force_clear_gpu_memory()
                 raise Exception("GPU out of memory during streaming generation. Try reducing image size.")
             
-            # Convert to base64
-            image_base64 = self._image_to_base64(image)
+            # Encode each image in its requested format
+            delivered = await asyncio.gather(*(
+                self._deliver_image(
+                    image, request,
+                    self._cache_key('streaming_generative', request, seed) if request.seed is not None else None
+                )
+                for image, request, seed in zip(images, requests, seeds)
+            ))
             
             # Quick cleanup for streaming
-            del image
+            del images
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             
             processing_time = time.time() - start_time
-            logger.info(f"✅ Streaming image generated in {processing_time:.2f}s")
-            
-            return StreamingGenerativeResponse(
-                image_base64=image_base64,
-                prompt_used=request.prompt,
-                processing_time=processing_time,
-                model_used="stabilityai/sdxl-turbo"
-            )
+            logger.info(f"✅ {len(requests)} streaming image(s) generated in {processing_time:.2f}s")
+            
+            return [
+                StreamingGenerativeResponse(
+                    **fields,
+                    prompt_used=request.prompt,
+                    processing_time=processing_time,
+                    model_used="stabilityai/sdxl-turbo",
+                    seed=seed
+                )
+                for request, fields, seed in zip(requests, delivered, seeds)
+            ]
             
         except Exception as e:
             logger.error(f"❌ Error generating streaming image: {e}")
             # Light memory cleanup on error for streaming
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
-            return StreamingGenerativeResponse(
-                success=False,
-                message=f"Failed to generate streaming image: {str(e)}",
-                image_base64="",
-                prompt_used=request.prompt,
-                processing_time=time.time() - start_time
-            )
+            return [
+                StreamingGenerativeResponse(
+                    success=False,
+                    message=f"Failed to generate streaming image: {str(e)}",
+                    image_base64="",
+                    prompt_used=request.prompt,
+                    processing_time=time.time() - start_time
+                )
+                for request in requests
+            ]
+
+def streaming_batch_key(request: StreamingGenerativeRequest) -> tuple:
+    """Streaming requests can share a pipeline call when these match"""
+    return (request.width, request.height, request.num_inference_steps, request.guidance_scale)
 
 # Global service instance
-generative_service = GenerativeService() 
\ No newline at end of file
+generative_service = GenerativeService()
+
+async def _run_art_job(job: GenerationJob) -> GenerativeArtResponse:
+    """Execute a queued art job, reporting steps and (when a listener is attached) previews"""
+    preview_every = getattr(job.request, 'preview_every', 5)
+    # Looked up per preview, so a listener that detaches mid-generation stops receiving them
+    preview_callback = job.report_preview if job.preview_callback is not None else None
+    return await generative_service.generate_art(job.request, job.report_progress, preview_callback, preview_every)
+
+async def _run_streaming_jobs(jobs: List[GenerationJob]) -> List[StreamingGenerativeResponse]:
+    return await generative_service.generate_streaming_batch([job.request for job in jobs])
+
+async def _run_video_job(job: GenerationJob) -> GenerativeVideoResponse:
+    """Execute a queued video job, reporting pipeline steps as progress"""
+    response = await generative_service.generate_video(job.request, job.report_progress)
+    if response.success and response.video_filename:
+        response.video_url = f"/videos/{response.video_filename}"
+    return response
+
+# All generation runs through one scheduler (one job on the accelerator at a time), grouped by model
+# to avoid pipeline swaps; each model's max wait bounds how long affinity may delay its jobs
+generation_scheduler = AffinityScheduler(
+    handlers={
+        'generative_art': _run_art_job,
+        'generative_video': _run_video_job,
+        'streaming_generative': _run_streaming_jobs
+    },
+    is_resident=model_manager.is_model_loaded,
+    max_wait={
+        'generative_art': float(os.getenv('ART_MAX_WAIT_SECONDS', '20')),
+        'generative_video': float(os.getenv('VIDEO_MAX_WAIT_SECONDS', '60')),
+        'streaming_generative': float(os.getenv('STREAMING_MAX_WAIT_SECONDS', '3'))
+    },
+    max_queue_size=int(os.getenv('GENERATION_QUEUE_SIZE', '8')),
+    max_batch=int(os.getenv('SCHEDULER_MAX_BATCH', '8')),
+    result_ttl=float(os.getenv('GENERATION_JOB_RESULT_TTL_SECONDS', '3600')),
+    # Concurrent SDXL-Turbo requests of the same shape are collected briefly and run as one batch
+    batch_keys={'streaming_generative': streaming_batch_key},
+    batch_window=float(os.getenv('STREAMING_BATCH_WINDOW_MS', '10')) / 1000,
+    max_batch_size=int(os.getenv('STREAMING_MAX_BATCH_SIZE', '4'))
+)
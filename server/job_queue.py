@@ -0,0 +1,296 @@
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """Raised when a job queue is at capacity (the caller should shed the request)"""
+
+class GenerationJob:
+    """A queued generation request and its progress"""
+
+    __slots__ = (
+        'id', 'kind', 'request', 'status', 'step', 'total_steps', 'result', 'error',
+        'created_at', 'started_at', 'finished_at', 'done_event', 'preview_callback'
+    )
+
+    def __init__(
+        self,
+        kind: str,
+        request: Any,
+        total_steps: int = 0,
+        preview_callback: Optional[Callable[[int, str], None]] = None
+    ):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.request = request
+        self.status = "queued"  # queued | running | done | failed
+        self.step = 0
+        self.total_steps = total_steps
+        self.result: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done_event = asyncio.Event()
+        self.preview_callback = preview_callback  # Intermediate results (called from a worker thread)
+
+    def report_progress(self, step: int) -> None:
+        """Pipeline step callback (may be called from a worker thread)"""
+        self.step = step
+
+    def report_preview(self, step: int, image_base64: str) -> None:
+        """Pipeline preview callback: forwards to the listener, if one is still attached"""
+        preview_callback = self.preview_callback
+        if preview_callback is not None:
+            preview_callback(step, image_base64)
+
+    @property
+    def progress(self) -> float:
+        if self.status == "done":
+            return 1.0
+        return min(self.step / self.total_steps, 1.0) if self.total_steps else 0.0
+
+    async def wait(self) -> "GenerationJob":
+        await self.done_event.wait()
+        return self
+
+class AffinityScheduler:
+    """Per-model job queues drained by one worker that prefers models already resident
+
+    Jobs for the model that just ran (or any resident one) go first so pipelines are not swapped on every
+    request; a job waiting longer than its model's max wait is served next regardless, so nobody starves.
+    Kinds listed in batch_keys are micro-batched: their handler takes a list of jobs sharing the same key
+    (collected for batch_window seconds) and returns one result per job, in order.
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[GenerationJob], Awaitable[Any]]],
+        is_resident: Callable[[str], bool],
+        max_wait: Dict[str, float],
+        max_queue_size: int = 8,
+        max_batch: int = 8,
+        result_ttl: float = 3600.0,
+        batch_keys: Optional[Dict[str, Callable[[Any], Hashable]]] = None,
+        batch_window: float = 0.01,
+        max_batch_size: int = 4
+    ):
+        self.handlers = handlers
+        self.is_resident = is_resident
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.max_batch = max_batch
+        self.result_ttl = result_ttl
+        self.batch_keys = batch_keys or {}
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+
+        self.queues: Dict[str, Deque[GenerationJob]] = {kind: deque() for kind in handlers}
+        self.jobs: "OrderedDict[str, GenerationJob]" = OrderedDict()
+        self.current_kind: Optional[str] = None
+        self._batch_count = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {
+            'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+            'swaps': 0, 'swaps_avoided': 0, 'overdue_dispatches': 0,
+            'batches': 0, 'batched_jobs': 0
+        }
+
+    def start(self) -> None:
+        """Start the worker (needs a running event loop)"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancel the worker and fail every queued job, so that nobody waits on them forever"""
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.cancel()
+            try:
+                # The running batch marks its jobs failed on cancellation
+                await worker
+            except asyncio.CancelledError:
+                pass
+
+        finished_at = time.time()
+        for queue in self.queues.values():
+            while queue:
+                job = queue.popleft()
+                job.status = "failed"
+                job.error = "Scheduler stopped"
+                job.finished_at = finished_at
+                self.stats['failed'] += 1
+                job.done_event.set()
+
+    def submit(
+        self,
+        kind: str,
+        request: Any,
+        total_steps: int = 0,
+        preview_callback: Optional[Callable[[int, str], None]] = None
+    ) -> GenerationJob:
+        """Queue a job for a model; raises QueueFullError when that model's queue is full"""
+        self.start()
+
+        queue = self.queues[kind]
+        if len(queue) >= self.max_queue_size:
+            self.stats['rejected'] += 1
+            raise QueueFullError(f"{kind} queue is full ({self.max_queue_size} jobs waiting)")
+
+        job = GenerationJob(kind, request, total_steps, preview_callback)
+        queue.append(job)
+        self.jobs[job.id] = job
+        self.stats['submitted'] += 1
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        return self.jobs.get(job_id)
+
+    def queue_position(self, job: GenerationJob) -> Optional[int]:
+        """1-based position within its model's queue (None once started)"""
+        if job.status != "queued":
+            return None
+        try:
+            return self.queues[job.kind].index(job) + 1
+        except ValueError:
+            return None
+
+    def _next_kind(self) -> Optional[str]:
+        heads = {kind: queue[0] for kind, queue in self.queues.items() if queue}
+        if not heads:
+            return None
+
+        now = time.time()
+        oldest_kind = min(heads, key=lambda kind: heads[kind].created_at)
+
+        # Latency bound: the most overdue job goes first
+        overdue = {
+            kind: (now - job.created_at) / self.max_wait[kind]
+            for kind, job in heads.items()
+            if now - job.created_at >= self.max_wait[kind]
+        }
+        if overdue:
+            self.stats['overdue_dispatches'] += 1
+            return max(overdue, key=overdue.get)
+
+        if self.current_kind in heads and self._batch_count < self.max_batch:
+            chosen = self.current_kind
+        else:
+            # A full batch yields to the other models' queues (if any)
+            candidates = [kind for kind in heads if kind != self.current_kind] or list(heads)
+            resident = [kind for kind in candidates if self.is_resident(kind)]
+            chosen = min(resident or candidates, key=lambda kind: heads[kind].created_at)
+
+        if chosen != oldest_kind and not self.is_resident(oldest_kind):
+            self.stats['swaps_avoided'] += 1
+        return chosen
+
+    async def _run(self) -> None:
+        while True:
+            kind = self._next_kind()
+            if kind is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if kind == self.current_kind:
+                self._batch_count += 1
+            else:
+                # A swap is switching away from another model to one that has to be loaded (not the first load)
+                if self.current_kind is not None and not self.is_resident(kind):
+                    self.stats['swaps'] += 1
+                self.current_kind = kind
+                self._batch_count = 1
+
+            if kind in self.batch_keys:
+                await self._execute_batch(kind, await self._collect_batch(kind))
+            else:
+                await self._execute_batch(kind, [self.queues[kind].popleft()])
+
+    async def _collect_batch(self, kind: str) -> List[GenerationJob]:
+        """Pop the head job plus queued jobs of the same kind that share its batch key"""
+        queue = self.queues[kind]
+        if len(queue) < self.max_batch_size and self.batch_window > 0:
+            # Give concurrent requests a moment to arrive
+            await asyncio.sleep(self.batch_window)
+
+        key_of = self.batch_keys[kind]
+        head = queue.popleft()
+        key = key_of(head.request)
+        batch = [head]
+        for job in list(queue):
+            if len(batch) >= self.max_batch_size:
+                break
+            if key_of(job.request) == key:
+                queue.remove(job)
+                batch.append(job)
+        return batch
+
+    async def _execute_batch(self, kind: str, jobs: List[GenerationJob]) -> None:
+        started_at = time.time()
+        for job in jobs:
+            job.status = "running"
+            job.started_at = started_at
+
+        try:
+            if kind in self.batch_keys:
+                results = await self.handlers[kind](jobs)
+                self.stats['batches'] += 1
+                self.stats['batched_jobs'] += len(jobs)
+            else:
+                results = [await self.handlers[kind](jobs[0])]
+
+            for job, result in zip(jobs, results):
+                job.result = result
+                job.status = "done" if getattr(result, 'success', True) else "failed"
+                if job.status == "failed":
+                    job.error = getattr(result, 'message', None)
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.status = "failed"
+                job.error = "Cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"❌ {kind} batch of {len(jobs)} job(s) failed: {e}")
+            for job in jobs:
+                job.status = "failed"
+                job.error = str(e)
+        finally:
+            finished_at = time.time()
+            for job in jobs:
+                if job.status == "running":
+                    job.status = "failed"
+                    job.error = "No result returned"
+                job.finished_at = finished_at
+                self.stats['completed' if job.status == "done" else 'failed'] += 1
+                job.done_event.set()
+
+    def prune(self) -> int:
+        """Forget finished jobs older than the result TTL"""
+        cutoff = time.time() - self.result_ttl
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depths': {kind: len(queue) for kind, queue in self.queues.items()},
+            'max_queue_size': self.max_queue_size,
+            'max_batch_size': self.max_batch_size,
+            'current_model': self.current_kind,
+            'tracked_jobs': len(self.jobs),
+            **self.stats
+        }
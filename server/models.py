@@ -21,6 +21,7 @@ class HealthResponse(BaseResponse):
     status: str = "healthy"
     uptime: float = 0.0
     models_loaded: Dict[str, bool] = {}
+    dependencies: Dict[str, Dict[str, Any]] = {}
     
 # Finance AI models
 class FinanceCommand(BaseModel):
@@ -35,11 +36,22 @@ class TransactionData(BaseModel):
     category: Optional[str] = None
     confidence: Optional[float] = Field(None, ge=0, le=1)
 
+    class Config:
+        frozen = True  # Instances are shared through the parser LRU cache
+
+class SpendingAnomaly(BaseModel):
+    category: str
+    amount: float
+    typical_amount: float = Field(..., description="Typical (geometric mean) amount for this user and category")
+    z_score: float
+    message: str = ""
+
 class FinanceResponse(BaseResponse):
     transaction: Optional[TransactionData] = None
     response_text: str = ""
     parsed_successfully: bool = True
     confidence: float = 0.95
+    anomaly: Optional[SpendingAnomaly] = None
 
 class FinanceInsightsRequest(BaseModel):
     transactions: List[Dict[str, Any]] = []
@@ -50,6 +62,7 @@ class FinanceInsightsResponse(BaseResponse):
     recommendations: List[str] = []
     trends: Dict[str, Any] = {}
     summary: str = ""
+    recurring_payments: List[Dict[str, Any]] = []
 
 # Blockchain Analysis models
 class WalletAnalysisRequest(BaseModel):
@@ -134,6 +147,29 @@ class StudyChatResponse(BaseResponse):
     follow_up_questions: List[str] = []
     related_topics: List[str] = []
     processing_time: float = 0.0
+    cached: bool = False
+
+class StudyChatBatchRequest(BaseModel):
+    questions: List[str] = Field(..., min_length=1, max_length=50, description="Worksheet questions, answered in order")
+    subject: Optional[str] = None
+    difficulty: Optional[str] = Field(None, pattern="^(beginner|intermediate|advanced)$")
+    language: str = Field(default="vi", pattern="^(vi|en)$")
+    stream: bool = False  # Stream NDJSON results as they complete
+    
+    @validator('questions', each_item=True)
+    def validate_question(cls, v):
+        v = v.strip()
+        if not v:
+            raise ValueError('Question cannot be empty')
+        if len(v) > 5000:
+            raise ValueError('Question is too long (max 5000 characters)')
+        return v
+
+class StudyChatBatchResponse(BaseResponse):
+    results: List[StudyChatResponse] = []
+    total_questions: int = 0
+    failed_questions: int = 0
+    processing_time: float = 0.0
 
 # Model loading status
 class ModelStatus(BaseModel):
@@ -210,6 +246,8 @@ class StatsResponse(BaseResponse):
     stats: UsageStats
     models_status: List[ModelStatus]
     system_info: Dict[str, Any] = {}
+    cache_stats: Dict[str, "CacheStats"] = {}
+    queue_metrics: Dict[str, Dict[str, Any]] = {}
 
 # Validation models
 class ValidationResult(BaseModel):
@@ -218,15 +256,30 @@ class ValidationResult(BaseModel):
     warnings: List[str] = []
 
 # AI Collections models
-class GenerativeArtRequest(BaseModel):
+class ImageOutputOptions(BaseModel):
+    output_format: str = Field(default="png", pattern="^(png|webp|jpeg)$", description="Encoding of the generated image")
+    quality: int = Field(default=85, ge=1, le=100, description="WebP/JPEG quality (ignored for PNG)")
+    delivery: str = Field(default="base64", pattern="^(base64|url)$", description="Inline base64 or a content-addressed /images URL")
+    seed: Optional[int] = Field(default=None, ge=0, le=2**32 - 1, description="Fixed seed for reproducible (cacheable) output")
+
+class GeneratedImageResponse(BaseResponse):
+    image_base64: str = Field(default="", description="Generated image in base64 format (delivery=base64)")
+    image_url: str = Field(default="", description="URL of the generated image (delivery=url)")
+    media_type: str = "image/png"
+    seed: Optional[int] = Field(default=None, description="Seed the image was generated with")
+    cached: bool = False
+
+class GenerativeArtRequest(ImageOutputOptions):
     prompt: str = Field(..., min_length=1, max_length=1000, description="Prompt for image generation")
     num_inference_steps: int = Field(default=70, ge=10, le=100)
     guidance_scale: float = Field(default=5.0, ge=1.0, le=20.0)
     width: int = Field(default=512, ge=256, le=1024)
     height: int = Field(default=512, ge=256, le=1024)
 
-class GenerativeArtResponse(BaseResponse):
-    image_base64: str = Field(..., description="Generated image in base64 format")
+class ArtPreviewRequest(GenerativeArtRequest):
+    preview_every: int = Field(default=5, ge=1, le=50, description="Send a low-resolution preview every N steps")
+
+class GenerativeArtResponse(GeneratedImageResponse):
     prompt_used: str = ""
     processing_time: float = 0.0
     model_used: str = "prompthero/openjourney"
@@ -248,15 +301,28 @@ class GenerativeVideoResponse(BaseResponse):
     fps: int = 5
     model_used: str = "ByteDance/AnimateDiff-Lightning"
 
-class StreamingGenerativeRequest(BaseModel):
+class GenerationJobResponse(BaseResponse):
+    job_id: str
+    kind: str
+    status: str = Field(..., description="queued | running | done | failed")
+    queue_position: Optional[int] = None
+    progress: float = Field(default=0.0, ge=0, le=1)
+    step: int = 0
+    total_steps: int = 0
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class StreamingGenerativeRequest(ImageOutputOptions):
     prompt: str = Field(..., min_length=1, max_length=1000, description="Prompt for streaming image generation")
     num_inference_steps: int = Field(default=2, ge=1, le=5)
     guidance_scale: float = Field(default=0.0, ge=0.0, le=1.0)
     width: int = Field(default=512, ge=256, le=1024)
     height: int = Field(default=512, ge=256, le=1024)
 
-class StreamingGenerativeResponse(BaseResponse):
-    image_base64: str = Field(..., description="Generated image in base64 format")
+class StreamingGenerativeResponse(GeneratedImageResponse):
     prompt_used: str = ""
     processing_time: float = 0.0
     model_used: str = "stabilityai/sdxl-turbo"
@@ -285,6 +351,12 @@ class CacheEntry(BaseModel):
 
 class CacheStats(BaseModel):
     total_entries: int = 0
+    max_entries: int = 0
+    hits: int = 0
+    disk_hits: int = 0
+    near_duplicate_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
     hit_rate: float = 0.0
     memory_usage: float = 0.0
     oldest_entry: Optional[datetime] = None
@@ -302,4 +374,5 @@ class SmartPlanningResponse(BaseResponse):
     recommendations: List[str] = []
     risk_assessment: str = ""
     timeline: str = ""
-    processing_time: float = 0.0
\ No newline at end of file
+    processing_time: float = 0.0
+    cached: bool = False
\ No newline at end of file
@@ -16,10 +16,10 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import ValidationError
 
 # Import models and services
@@ -27,22 +27,25 @@ from models import (
     HealthResponse, 
     FinanceCommand, FinanceResponse, FinanceInsightsRequest, FinanceInsightsResponse,
     WalletAnalysisRequest, BlockchainAnalysisResponse,
-    StudyChatRequest, StudyChatResponse,
+    StudyChatRequest, StudyChatResponse, StudyChatBatchRequest, StudyChatBatchResponse,
     ModelsStatusResponse, ModelStatus,
     ErrorResponse, ErrorDetail,
     StatsResponse, UsageStats,
-    GenerativeArtRequest, GenerativeArtResponse,
+    GenerativeArtRequest, GenerativeArtResponse, ArtPreviewRequest,
     GenerativeVideoRequest, GenerativeVideoResponse,
     StreamingGenerativeRequest, StreamingGenerativeResponse,
     ModelLoadRequest, ModelLoadResponse, ModelUnloadRequest,
-    SmartPlanningRequest, SmartPlanningResponse
+    SmartPlanningRequest, SmartPlanningResponse,
+    GenerationJobResponse
 )
 
 from blockchain_analyzer import blockchain_service
 from study_chat import StudyChatService
-from finance_manager import finance_service, query_generator
-from generative_service import generative_service
+from finance_manager import finance_service, query_generator, iter_ndjson_rows, smart_plan_cache, build_plan_fingerprint
+from generative_service import generative_service, generation_scheduler
+from job_queue import AffinityScheduler, GenerationJob, QueueFullError
 from model_manager import model_manager
+from gemini_client import gemini_client
 
 # Configure logging
 logging.basicConfig(
@@ -126,10 +129,14 @@ async def lifespan(app: FastAPI):
     """Manage application lifespan"""
     # Startup
     await initialize_services()
+    generation_scheduler.start()
     asyncio.create_task(cleanup_task())  
     yield
     # Shutdown
     logger.info("🔄 Shutting down AI Server...")
+    study_service.llm_assistant.stop_health_probe()
+    await generation_scheduler.stop()
+    gemini_client.shutdown()
 
 # Create FastAPI app
 app = FastAPI(
@@ -256,13 +263,15 @@ async def custom_http_exception_handler(request, exc):
 async def health_check():
     """Health check endpoint"""
     uptime = time.time() - app_state['start_time']
+    gemini_status = gemini_client.get_status()
     
     return HealthResponse(
         service="Student AI Server",
         version="1.0.0",
-        status="healthy",
+        status="healthy" if gemini_status['state'] == "closed" else "degraded",
         uptime=uptime,
-        models_loaded=app_state['models_loaded']
+        models_loaded=app_state['models_loaded'],
+        dependencies={'gemini': gemini_status}
     )
 
 # Models status endpoint
@@ -335,7 +344,7 @@ async def process_finance_command(request: FinanceCommand):
             )
         
         # Process normal transaction commands
-        response = await finance_service.process_command(request.command)
+        response = await finance_service.process_command(request.command, request.user_id, parsed_transaction)
         return response
     except Exception as e:
         logger.error(f"Finance AI error: {e}")
@@ -353,6 +362,21 @@ async def generate_finance_insights(request: FinanceInsightsRequest):
         app_state['service_stats']['errors'] += 1
         raise HTTPException(status_code=500, detail=f"Insights generation failed: {str(e)}")
 
+@app.post("/finance-insights/stream", response_model=FinanceInsightsResponse)
+async def generate_finance_insights_stream(
+    request: Request,
+    period: str = Query(default="month", pattern="^(week|month|quarter|year)$")
+):
+    """Generate financial insights from an NDJSON (one transaction per line) or chunked body"""
+    try:
+        rows = iter_ndjson_rows(request.stream())
+        response = await finance_service.generate_insights_from_stream(rows, period)
+        return response
+    except Exception as e:
+        logger.error(f"Finance insights stream error: {e}")
+        app_state['service_stats']['errors'] += 1
+        raise HTTPException(status_code=500, detail=f"Insights generation failed: {str(e)}")
+
 @app.post("/finance-query")
 async def process_finance_query(request: Dict[str, Any]):
     """Process special finance queries (daily expenses, monthly summary, etc.)"""
@@ -391,16 +415,21 @@ async def generate_smart_plan(request: SmartPlanningRequest):
     try:
         logger.info(f"📊 Generating smart plan for goal: {request.goal_type}")
         
-        # Import Google Generative AI
-        import google.generativeai as genai
-        
-        # Configure Gemini API
-        api_key = os.getenv("GOOGLE_API_KEY", "GOOGLE_API_KEY")
-        if not api_key:
-            raise ValueError("GOOGLE_API_KEY not found")
-        
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-exp"))
+        # Serve common profiles from cache
+        cache_key = build_plan_fingerprint(request.financial_summary, request.goal_type)
+        cached_plan = await smart_plan_cache.aget(cache_key)
+        if cached_plan:
+            processing_time = time.time() - start_time
+            logger.info(f"✅ Smart planning served from cache - {processing_time:.3f}s")
+            return SmartPlanningResponse(
+                plan=cached_plan,
+                goal_type=request.goal_type,
+                recommendations=[],
+                risk_assessment="",
+                timeline="",
+                processing_time=processing_time,
+                cached=True
+            )
         
         # Prepare financial analysis from user data
         financial_data = request.financial_summary
@@ -503,18 +532,23 @@ Hãy phân tích và đưa ra kế hoạch đầu tư bao gồm:
 Trả lời bằng tiếng Việt, sử dụng emoji và format markdown. Đưa ra các con số cụ thể và thực tế.
 """
 
-        # Generate response from Gemini
-        response = model.generate_content(prompt)
+        # Generate response from Gemini (shared client, non-blocking)
+        plan_text = await gemini_client.generate(
+            prompt,
+            timeout=float(os.getenv("SMART_PLANNING_TIMEOUT_SECONDS", "45"))
+        )
         
-        if not response.text:
+        if not plan_text:
             raise ValueError("Không thể tạo kế hoạch từ AI")
         
+        await smart_plan_cache.aset(cache_key, plan_text)
+        
         processing_time = time.time() - start_time
         
         logger.info(f"✅ Smart planning generated successfully - {processing_time:.3f}s")
         
         return SmartPlanningResponse(
-            plan=response.text,
+            plan=plan_text,
             goal_type=request.goal_type,
             recommendations=[],
             risk_assessment="",
@@ -664,6 +698,54 @@ async def study_chat(request: StudyChatRequest):
         app_state['service_stats']['errors'] += 1
         raise HTTPException(status_code=500, detail=f"Study chat failed: {str(e)}")
 
+@app.post("/study-chat/stream")
+async def study_chat_stream(request: StudyChatRequest):
+    """Process study chat message, streaming the answer as server-sent events"""
+    app_state['service_stats']['study_requests'] += 1
+    
+    if not study_service.is_initialized:
+        raise HTTPException(
+            status_code=503,
+            detail="Study chat service not available. Please try again later."
+        )
+    
+    return StreamingResponse(
+        study_service.stream_message(request),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@app.post("/study-chat/batch", response_model=StudyChatBatchResponse)
+async def study_chat_batch(request: StudyChatBatchRequest):
+    """Answer a worksheet of study questions concurrently (NDJSON stream when request.stream is set)"""
+    try:
+        app_state['service_stats']['study_requests'] += len(request.questions)
+        
+        if not study_service.is_initialized:
+            raise HTTPException(
+                status_code=503,
+                detail="Study chat service not available. Please try again later."
+            )
+        
+        if request.stream:
+            return StreamingResponse(
+                study_service.stream_batch(request),
+                media_type="application/x-ndjson",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        return await study_service.process_batch(request)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Study chat batch error: {e}")
+        app_state['service_stats']['errors'] += 1
+        raise HTTPException(status_code=500, detail=f"Study chat batch failed: {str(e)}")
+
 # AI Collections endpoints
 @app.post("/generate-art", response_model=GenerativeArtResponse)
 async def generate_art(request: GenerativeArtRequest):
@@ -672,9 +754,18 @@ async def generate_art(request: GenerativeArtRequest):
         app_state['service_stats']['generative_art_requests'] += 1
         logger.info(f"🎨 Art generation request: {request.prompt[:50]}...")
         
-        response = await generative_service.generate_art(request)
+        # Cache hits for seeded requests skip the queue and the model
+        response = await generative_service.lookup_cached('generative_art', request)
+        if response is None:
+            job = await _submit_job('generative_art', request, request.num_inference_steps).wait()
+            response = job.result
         
-        if response.success:
+        if response is None:
+            raise RuntimeError(job.error or "Art job did not produce a result")
+        
+        if response.cached:
+            logger.info("♻️ Art served from the generation cache")
+        elif response.success:
             app_state['models_loaded']['generative_art'] = True
             logger.info(f"✅ Art generated successfully in {response.processing_time:.2f}s")
         else:
@@ -682,36 +773,193 @@ async def generate_art(request: GenerativeArtRequest):
             
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Art generation error: {e}")
         app_state['service_stats']['errors'] += 1
         raise HTTPException(status_code=500, detail=f"Art generation failed: {str(e)}")
 
+@app.websocket("/ws/generate-art")
+async def generate_art_previews(websocket: WebSocket):
+    """Generate art and stream low-resolution previews every N steps, then the final image
+    
+    The client sends one ArtPreviewRequest as JSON and receives messages of type
+    queued, preview (step, base64 JPEG), result (GenerativeArtResponse) or error.
+    """
+    await websocket.accept()
+    
+    if not check_rate_limit(websocket.client.host if websocket.client else "unknown"):
+        await websocket.send_json({'type': 'error', 'message': "Rate limit exceeded"})
+        await websocket.close(code=1008)
+        return
+    
+    try:
+        request = ArtPreviewRequest(**await websocket.receive_json())
+    except WebSocketDisconnect:
+        return
+    except (ValidationError, ValueError, TypeError) as e:
+        await websocket.send_json({'type': 'error', 'message': f"Invalid request: {e}"})
+        await websocket.close(code=1003)
+        return
+    
+    app_state['service_stats']['generative_art_requests'] += 1
+    logger.info(f"🎨 Art preview request: {request.prompt[:50]}...")
+    
+    job = None
+    try:
+        # Seeded request generated before: nothing to preview
+        response = await generative_service.lookup_cached('generative_art', request)
+        
+        if response is None:
+            loop = asyncio.get_running_loop()
+            previews: asyncio.Queue = asyncio.Queue()
+            
+            def on_preview(step: int, image_base64: str) -> None:
+                # Called on the pipeline thread
+                loop.call_soon_threadsafe(previews.put_nowait, {
+                    'type': 'preview',
+                    'step': step,
+                    'total_steps': request.num_inference_steps,
+                    'media_type': 'image/jpeg',
+                    'image_base64': image_base64
+                })
+            
+            try:
+                job = generation_scheduler.submit(
+                    'generative_art', request, request.num_inference_steps, preview_callback=on_preview
+                )
+            except QueueFullError as e:
+                logger.warning(f"⚠️ {e}")
+                await websocket.send_json({'type': 'error', 'message': str(e)})
+                await websocket.close(code=1013)
+                return
+            
+            await websocket.send_json({
+                'type': 'queued',
+                'job_id': job.id,
+                'queue_position': generation_scheduler.queue_position(job)
+            })
+            
+            # Forward previews until the job finishes
+            done = asyncio.ensure_future(job.wait())
+            while not done.done():
+                next_preview = asyncio.ensure_future(previews.get())
+                await asyncio.wait({done, next_preview}, return_when=asyncio.FIRST_COMPLETED)
+                if next_preview.done():
+                    await websocket.send_json(next_preview.result())
+                else:
+                    next_preview.cancel()
+            
+            # Previews posted just before the job finished are still queued
+            while not previews.empty():
+                await websocket.send_json(previews.get_nowait())
+            
+            response = job.result
+            if response is None:
+                raise RuntimeError(job.error or "Art job did not produce a result")
+        
+        if response.success:
+            if not response.cached:
+                app_state['models_loaded']['generative_art'] = True
+        else:
+            app_state['service_stats']['errors'] += 1
+        
+        await websocket.send_json({'type': 'result', **response.model_dump(mode='json')})
+        await websocket.close()
+        
+    except WebSocketDisconnect:
+        logger.info("🔌 Art preview client disconnected (generation continues in the queue)")
+    except Exception as e:
+        logger.error(f"❌ Art preview error: {e}")
+        app_state['service_stats']['errors'] += 1
+        try:
+            await websocket.send_json({'type': 'error', 'message': f"Art generation failed: {str(e)}"})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        if job is not None:
+            # Nobody is listening any more: stop encoding and queueing previews
+            job.preview_callback = None
+
+def _job_response(job: GenerationJob, scheduler: AffinityScheduler) -> GenerationJobResponse:
+    """Public view of a generation job"""
+    return GenerationJobResponse(
+        success=job.status != "failed",
+        message=job.error or f"Job {job.status}",
+        job_id=job.id,
+        kind=job.kind,
+        status=job.status,
+        queue_position=scheduler.queue_position(job),
+        progress=job.progress,
+        step=job.step,
+        total_steps=job.total_steps,
+        result=job.result.model_dump(mode='json') if job.result is not None else None,
+        error=job.error,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
+    )
+
+def _submit_job(kind: str, request: Any, total_steps: int = 0) -> GenerationJob:
+    """Queue a generation job or shed the request with 503 when that model's queue is full"""
+    try:
+        return generation_scheduler.submit(kind, request, total_steps=total_steps)
+    except QueueFullError as e:
+        logger.warning(f"⚠️ {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+def _submit_video_job(request: GenerativeVideoRequest) -> GenerationJob:
+    """Queue a video job"""
+    app_state['service_stats']['generative_video_requests'] += 1
+    logger.info(f"🎬 Video generation request: {request.prompt[:50]}...")
+    
+    return _submit_job('generative_video', request, request.num_inference_steps)
+
 @app.post("/generate-video", response_model=GenerativeVideoResponse)
 async def generate_video(request: GenerativeVideoRequest):
-    """Generate video using AnimateDiff-Lightning model"""
+    """Generate video using AnimateDiff-Lightning model (waits for the queued job)"""
     try:
-        app_state['service_stats']['generative_video_requests'] += 1
-        logger.info(f"🎬 Video generation request: {request.prompt[:50]}...")
+        job = await _submit_video_job(request).wait()
+        response = job.result
         
-        response = await generative_service.generate_video(request)
+        if response is None:
+            raise RuntimeError(job.error or "Video job did not produce a result")
         
         if response.success:
             app_state['models_loaded']['generative_video'] = True
-            # Set video URL if video was generated successfully
-            if response.video_filename:
-                response.video_url = f"/videos/{response.video_filename}"
             logger.info(f"✅ Video generated successfully in {response.processing_time:.2f}s")
         else:
             app_state['service_stats']['errors'] += 1
             
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Video generation error: {e}")
         app_state['service_stats']['errors'] += 1
         raise HTTPException(status_code=500, detail=f"Video generation failed: {str(e)}")
 
+@app.post("/generate-video/jobs", response_model=GenerationJobResponse, status_code=202)
+async def submit_video_job(request: GenerativeVideoRequest):
+    """Queue a video generation job and return its id immediately"""
+    job = _submit_video_job(request)
+    return _job_response(job, generation_scheduler)
+
+@app.get("/generate-video/jobs/{job_id}", response_model=GenerationJobResponse)
+async def get_video_job(job_id: str):
+    """Poll a video job: queued, running (with step progress), done or failed"""
+    job = generation_scheduler.get(job_id)
+    if job is None or job.kind != 'generative_video':
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    
+    if job.status == "done":
+        app_state['models_loaded']['generative_video'] = True
+    
+    return _job_response(job, generation_scheduler)
+
 @app.post("/generate-streaming", response_model=StreamingGenerativeResponse)
 async def generate_streaming(request: StreamingGenerativeRequest):
     """Generate streaming art using SDXL-Turbo model"""
@@ -719,9 +967,18 @@ async def generate_streaming(request: StreamingGenerativeRequest):
         app_state['service_stats']['streaming_generative_requests'] += 1
         logger.info(f"⚡ Streaming generation request: {request.prompt[:50]}...")
         
-        response = await generative_service.generate_streaming(request)
+        # Cache hits for seeded requests skip the queue and the model
+        response = await generative_service.lookup_cached('streaming_generative', request)
+        if response is None:
+            job = await _submit_job('streaming_generative', request, request.num_inference_steps).wait()
+            response = job.result
         
-        if response.success:
+        if response is None:
+            raise RuntimeError(job.error or "Streaming job did not produce a result")
+        
+        if response.cached:
+            logger.info("♻️ Streaming image served from the generation cache")
+        elif response.success:
             app_state['models_loaded']['streaming_generative'] = True
             logger.info(f"✅ Streaming image generated successfully in {response.processing_time:.2f}s")
         else:
@@ -729,6 +986,8 @@ async def generate_streaming(request: StreamingGenerativeRequest):
             
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Streaming generation error: {e}")
         app_state['service_stats']['errors'] += 1
@@ -770,6 +1029,29 @@ async def stream_video(filename: str):
         logger.error(f"❌ Error streaming video {filename}: {e}")
         raise HTTPException(status_code=500, detail="Failed to stream video")
 
+# Generated image endpoint (content-addressed, so responses never change)
+IMAGE_MEDIA_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+@app.get("/images/{filename}")
+async def get_image(filename: str):
+    """Serve a generated image stored with delivery=url"""
+    # Security: only <sha256>.<ext> names are valid
+    name, _, extension = filename.partition('.')
+    if len(name) != 64 or extension not in IMAGE_MEDIA_TYPES or not all(c in '0123456789abcdef' for c in name):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    
+    image_path = os.path.join(generative_service.images_dir, filename)
+    if not os.path.exists(image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    from fastapi.responses import FileResponse
+    
+    return FileResponse(
+        path=image_path,
+        media_type=IMAGE_MEDIA_TYPES[extension],
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
 # Model management endpoints
 @app.post("/models/load", response_model=ModelLoadResponse)
 async def load_model(request: ModelLoadRequest):
@@ -797,7 +1079,11 @@ async def unload_model(request: ModelUnloadRequest):
     try:
         logger.info(f"📥 Unloading model: {request.model_type}")
         
-        success = await model_manager.unload_model(request.model_type)
+        if model_manager.is_in_use(request.model_type):
+            raise HTTPException(status_code=409, detail=f"Model {request.model_type} is in use by a running generation")
+        
+        # An explicit unload frees the memory; only LRU eviction parks pipelines in host RAM
+        success = await model_manager.unload_model(request.model_type, park=False)
         
         if success:
             app_state['models_loaded'][request.model_type] = False
@@ -806,6 +1092,8 @@ async def unload_model(request: ModelUnloadRequest):
         else:
             return {"success": False, "message": f"Failed to unload model {request.model_type}"}
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Model unloading error: {e}")
         raise HTTPException(status_code=500, detail=f"Model unloading failed: {str(e)}")
@@ -994,10 +1282,25 @@ async def get_server_stats():
         'python_version': f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}"
     }
     
+    cache_stats = {
+        'finance_parser': finance_service.parser.parse_cache.get_stats(),
+        'smart_planning': smart_plan_cache.get_stats(),
+        'study_answers': study_service.answer_cache.get_stats(),
+        'generations': generative_service.generation_cache.get_stats(),
+        'generated_images': generative_service.image_store.get_stats(),
+        'prompt_embeddings': generative_service.embedding_cache.get_stats()
+    }
+    
     return StatsResponse(
         stats=stats,
         models_status=models_status,
-        system_info=system_info
+        system_info=system_info,
+        cache_stats=cache_stats,
+        queue_metrics={
+            'study_chat': study_service.llm_assistant.get_metrics(),
+            'study_conversations': study_service.conversation_store.get_stats(),
+            'generation_scheduler': generation_scheduler.get_stats()
+        }
     )
 
 # Root endpoint
@@ -1033,6 +1336,17 @@ async def cleanup_task():
                 if not rate_limit_storage[client_ip]:
                     del rate_limit_storage[client_ip]
             
+            # Forget old generation jobs
+            generation_scheduler.prune()
+            
+            # Drop idle study conversations
+            expired = study_service.conversation_store.evict_expired()
+            if expired:
+                logger.info(f"🧹 Evicted {expired} idle study conversations")
+            swept = await study_service.conversation_store.sweep_spills()
+            if swept:
+                logger.info(f"🧹 Deleted {swept} stale spilled study conversations")
+            
             await asyncio.sleep(300)  # Run every 5 minutes
             
         except Exception as e:
@@ -3,9 +3,16 @@ import logging
 import time
 import re
 import os
-from typing import Dict, List, Optional, Any, Tuple
-from datetime import datetime
-from models import StudyChatRequest, StudyChatResponse
+import json
+import random
+import hashlib
+import unicodedata
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Any, Tuple, Set, AsyncIterator
+from models import StudyChatRequest, StudyChatResponse, StudyChatBatchRequest, StudyChatBatchResponse, CacheStats
+from gemini_client import gemini_client
+from cache_utils import LRUCache
+from conversation_store import ConversationStore
 
 # Import Google Generative AI
 import google.generativeai as genai
@@ -53,6 +60,185 @@ class SubjectDetector:
         
         return 'khác'
 
+# Vietnamese tone marks (combining forms): grave, acute, tilde, hook above, dot below
+VIETNAMESE_TONE_MARKS = {'\u0300', '\u0301', '\u0303', '\u0309', '\u0323'}
+
+def normalize_question(text: str) -> str:
+    """Canonical question text for caching (diacritic-aware, independent of tone mark placement)"""
+    words = []
+    # Strip trailing punctuation first: moving tone marks would otherwise bury it mid-word ("gì?" -> "gi?" + mark)
+    for word in text.lower().rstrip('?.!… \t\n').split():
+        # "hoà" and "hòa" differ only in where the tone mark sits: move it to the end of the word
+        decomposed = unicodedata.normalize('NFD', word)
+        tones = ''.join(ch for ch in decomposed if ch in VIETNAMESE_TONE_MARKS)
+        base = ''.join(ch for ch in decomposed if ch not in VIETNAMESE_TONE_MARKS)
+        words.append(unicodedata.normalize('NFC', base) + tones)
+    
+    return ' '.join(words)
+
+class StudyAnswerCache:
+    """Answer cache keyed on (normalized question, subject, difficulty) with an optional MinHash near-duplicate tier"""
+    
+    NUM_PERMUTATIONS = 64
+    BANDS = 16  # 4 rows per band
+    _MERSENNE_PRIME = (1 << 61) - 1
+    
+    def __init__(self):
+        self.cache = LRUCache(
+            max_size=int(os.getenv('STUDY_CACHE_SIZE', '2048')),
+            ttl=float(os.getenv('STUDY_CACHE_TTL_SECONDS', '86400')),
+            on_evict=self._forget_signature
+        )
+        self.near_duplicates = os.getenv('STUDY_CACHE_NEAR_DUPLICATES', 'False').lower() == 'true'
+        self.similarity_threshold = float(os.getenv('STUDY_CACHE_SIMILARITY', '0.85'))
+        
+        # MinHash permutations (fixed seed so signatures are stable across restarts)
+        rng = random.Random(1729)
+        self._permutations = [
+            (rng.randrange(1, self._MERSENNE_PRIME), rng.randrange(0, self._MERSENNE_PRIME))
+            for _ in range(self.NUM_PERMUTATIONS)
+        ]
+        self._signatures: Dict[Tuple[str, str, str], Tuple[int, ...]] = {}
+        self._lsh_buckets: Dict[Tuple, Set[Tuple[str, str, str]]] = {}
+        
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    def get(self, question: str, subject: str, difficulty: str) -> Optional[Tuple[str, float]]:
+        """Look up a cached (response_text, confidence)"""
+        normalized = normalize_question(question)
+        key = (normalized, subject, difficulty)
+        
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.exact_hits += 1
+            return cached
+        
+        if self.near_duplicates:
+            similar_key = self._find_near_duplicate(normalized, subject, difficulty)
+            if similar_key is not None:
+                cached = self.cache.get(similar_key)
+                if cached is not None:
+                    self.near_hits += 1
+                    return cached
+        
+        self.misses += 1
+        return None
+    
+    def set(self, question: str, subject: str, difficulty: str, response_text: str, confidence: float) -> None:
+        """Store an answer"""
+        normalized = normalize_question(question)
+        key = (normalized, subject, difficulty)
+        
+        if self.near_duplicates and key not in self._signatures:
+            signature = self._minhash(normalized)
+            self._signatures[key] = signature
+            for band_key in self._band_keys(signature, subject, difficulty):
+                self._lsh_buckets.setdefault(band_key, set()).add(key)
+        
+        self.cache.set(key, (response_text, confidence))
+    
+    def _minhash(self, text: str) -> Tuple[int, ...]:
+        """MinHash signature over character 3-gram shingles"""
+        shingles = {text[i:i + 3] for i in range(max(len(text) - 2, 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+            for shingle in shingles
+        ]
+        return tuple(
+            min((a * h + b) % self._MERSENNE_PRIME for h in hashes)
+            for a, b in self._permutations
+        )
+    
+    def _band_keys(self, signature: Tuple[int, ...], subject: str, difficulty: str) -> List[Tuple]:
+        rows = self.NUM_PERMUTATIONS // self.BANDS
+        return [
+            (subject, difficulty, band, signature[band * rows:(band + 1) * rows])
+            for band in range(self.BANDS)
+        ]
+    
+    def _find_near_duplicate(self, normalized: str, subject: str, difficulty: str) -> Optional[Tuple[str, str, str]]:
+        """Most similar cached question above the similarity threshold (LSH candidates only)"""
+        signature = self._minhash(normalized)
+        
+        candidates = set()
+        for band_key in self._band_keys(signature, subject, difficulty):
+            candidates.update(self._lsh_buckets.get(band_key, ()))
+        
+        best_key, best_similarity = None, self.similarity_threshold
+        for candidate in candidates:
+            candidate_signature = self._signatures.get(candidate)
+            if candidate_signature is None:
+                continue
+            similarity = sum(1 for a, b in zip(signature, candidate_signature) if a == b) / self.NUM_PERMUTATIONS
+            if similarity >= best_similarity:
+                best_key, best_similarity = candidate, similarity
+        
+        return best_key
+    
+    def _forget_signature(self, key: Tuple[str, str, str]) -> None:
+        """Drop LSH entries of an evicted answer"""
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        
+        for band_key in self._band_keys(signature, key[1], key[2]):
+            bucket = self._lsh_buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._lsh_buckets[band_key]
+    
+    def get_stats(self) -> CacheStats:
+        """Get cache statistics"""
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return CacheStats(
+            total_entries=len(self.cache),
+            max_entries=self.cache.max_size,
+            hits=self.exact_hits + self.near_hits,
+            near_duplicate_hits=self.near_hits,
+            misses=self.misses,
+            evictions=self.cache.evictions,
+            hit_rate=(self.exact_hits + self.near_hits) / lookups if lookups else 0.0
+        )
+
+class ResponsePostProcessor:
+    """Incremental response clean-up, safe to run on partial (streamed) text"""
+    
+    def __init__(self):
+        self.pending_whitespace = ''
+        self.started = False
+        self.last_char = ''
+    
+    def feed(self, text: str) -> str:
+        """Clean a chunk; trailing whitespace is held back until more text arrives"""
+        output = []
+        for segment in re.findall(r'\s+|\S+', text):
+            if segment[0].isspace():
+                self.pending_whitespace += segment
+                continue
+            
+            # Leading whitespace is dropped, inner runs are collapsed
+            if self.started and self.pending_whitespace:
+                whitespace = re.sub(r'\n+', '\n', self.pending_whitespace)
+                output.append(re.sub(r' +', ' ', whitespace))
+            self.pending_whitespace = ''
+            
+            output.append(segment)
+            self.started = True
+            self.last_char = segment[-1]
+        
+        return ''.join(output)
+    
+    def finish(self) -> str:
+        """Final text once the stream ends: trailing whitespace dropped, closing punctuation ensured"""
+        self.pending_whitespace = ''
+        if self.started and self.last_char not in '.!?':
+            self.last_char = '.'
+            return '.'
+        return ''
+
 class StudyAssistantLLM:
     """Study assistant using Google Gemini API for Vietnamese education"""
     
@@ -63,6 +249,23 @@ class StudyAssistantLLM:
         self.model = None
         self.is_loaded = False
         
+        # Concurrency control for Gemini calls
+        self.max_concurrency = int(os.getenv('STUDY_CHAT_MAX_CONCURRENCY', '4'))
+        self.request_timeout = float(os.getenv('STUDY_CHAT_TIMEOUT_SECONDS', '30'))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.summary_max_chars = int(os.getenv('STUDY_CONTEXT_SUMMARY_MAX_CHARS', '1200'))
+        self.probe_interval = float(os.getenv('STUDY_CHAT_PROBE_INTERVAL_SECONDS', '300'))
+        self._probe_task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'in_flight': 0,
+            'completed': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'total_wait_time': 0.0
+        }
+        
         # Vietnamese education context
         self.education_context = {
             'grade_levels': ['tiểu học', 'trung học cơ sở', 'trung học phổ thông', 'đại học'],
@@ -79,40 +282,48 @@ class StudyAssistantLLM:
         }
         
     async def load_model(self) -> bool:
-        """Initialize Google Gemini API"""
+        """Initialize Google Gemini API (no network round trip; connectivity is probed in the background)"""
         try:
             logger.info("Initializing Google Gemini API...")
             
-            # Configure the API
-            genai.configure(api_key=self.api_key)
+            # Configure the API and get the shared model instance
+            if self.api_key and not gemini_client.api_key:
+                gemini_client.api_key = self.api_key
+            self.model = gemini_client.get_model(self.model_name)
             
-            # Initialize the model
-            self.model = genai.GenerativeModel(self.model_name)
-            
-            # Test the connection
-            test_response = await self._generate_test_response()
-            if test_response:
-                self.is_loaded = True
-                logger.info("Google Gemini API initialized successfully")
-                return True
-            else:
-                logger.error("Failed to test Gemini API connection")
-                return False
+            self.is_loaded = True
+            self.start_health_probe()
+            logger.info("Google Gemini API configured, connectivity probe scheduled")
+            return True
             
         except Exception as e:
             logger.error(f"Error initializing Gemini API: {e}")
             return False
     
-    async def _generate_test_response(self) -> bool:
-        """Test Gemini API connection"""
-        try:
-            response = self.model.generate_content("Hello, test connection")
-            return response and response.text
-        except Exception as e:
-            logger.error(f"Gemini API test failed: {e}")
-            return False
+    def start_health_probe(self) -> None:
+        """Start the background Gemini connectivity probe"""
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+    
+    def stop_health_probe(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
     
-    def create_study_prompt(self, question: str, subject: str, difficulty: str = "intermediate") -> str:
+    async def _probe_loop(self) -> None:
+        """Probe Gemini now and then periodically; retry sooner while the circuit is open"""
+        while True:
+            try:
+                if await gemini_client.probe(self.model_name, timeout=self.request_timeout):
+                    logger.info("Gemini connectivity probe succeeded")
+                await asyncio.sleep(self.probe_interval if gemini_client.state == "closed" else gemini_client.reset_timeout)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Gemini probe loop error: {e}")
+                await asyncio.sleep(self.probe_interval)
+    
+    def create_study_prompt(self, question: str, subject: str, difficulty: str = "intermediate", context: str = "") -> str:
         """Create specialized prompt for educational content"""
         
         # Base system prompt for Vietnamese education
@@ -218,6 +429,12 @@ NGUYÊN TẮC TRẢ LỜI:
         if difficulty in difficulty_instructions:
             prompt += f"\n{difficulty_instructions[difficulty]}\n"
         
+        if context:
+            prompt += f"""
+💬 NGỮ CẢNH CUỘC TRÒ CHUYỆN TRƯỚC ĐÓ:
+{context}
+"""
+        
         prompt += f"""
 📝 CÂU HỎI CỦA HỌC SINH: {question}
 
@@ -227,35 +444,33 @@ Hãy trả lời câu hỏi này một cách chi tiết, dễ hiểu và có tí
         
         return prompt
     
-    async def generate_response(self, question: str, subject: str = "khác", difficulty: str = "intermediate") -> Tuple[str, float]:
+    async def generate_response(self, question: str, subject: str = "khác", difficulty: str = "intermediate", context: str = "") -> Tuple[str, float]:
         """Generate educational response using Gemini API"""
         if not self.is_loaded:
             return self._generate_fallback_response(question, subject), 0.5
         
         try:
             # Create educational prompt
-            prompt = self.create_study_prompt(question, subject, difficulty)
+            prompt = self.create_study_prompt(question, subject, difficulty, context)
             
             logger.info("Generating study assistance response with Gemini...")
             
             start_time = time.time()
             
-            # Generate response using Gemini
-            response = self.model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7,
-                    top_p=0.95,
-                    top_k=40,
-                    max_output_tokens=1024,
+            # Generate response using Gemini (non-blocking, concurrency limited)
+            async with self._generation_slot() as deadline:
+                raw_text = await gemini_client.generate(
+                    prompt,
+                    generation_config=self._generation_config(),
+                    model_name=self.model_name,
+                    timeout=max(deadline - time.monotonic(), 0.1)
                 )
-            )
             
             generation_time = time.time() - start_time
             
-            if response and response.text:
+            if raw_text:
                 # Post-process response
-                response_text = self._post_process_response(response.text)
+                response_text = self._post_process_response(raw_text)
                 
                 logger.info(f"Response generated in {generation_time:.2f}s")
                 return response_text, 0.95
@@ -263,24 +478,164 @@ Hãy trả lời câu hỏi này một cách chi tiết, dễ hiểu và có tí
                 logger.warning("Empty response from Gemini API")
                 return self._generate_fallback_response(question, subject), 0.5
                 
+        except asyncio.TimeoutError:
+            logger.error(f"Gemini generation exceeded {self.request_timeout:.0f}s deadline")
+            return self._generate_fallback_response(question, subject), 0.3
         except Exception as e:
             logger.error(f"Error in Gemini generation: {e}")
             return self._generate_fallback_response(question, subject), 0.3
     
-    def _post_process_response(self, response: str) -> str:
-        """Post-process the generated response"""
-        # Remove any incomplete sentences at the end
-        response = response.strip()
+    async def stream_response(self, question: str, subject: str = "khác", difficulty: str = "intermediate", context: str = "") -> AsyncIterator[Tuple[str, float]]:
+        """Stream a post-processed educational response as (text, confidence) chunks"""
+        if not self.is_loaded:
+            yield self._generate_fallback_response(question, subject), 0.5
+            return
+        
+        processor = ResponsePostProcessor()
+        emitted = False
         
-        # Clean up common generation artifacts
-        response = re.sub(r'\n+', '\n', response)
-        response = re.sub(r' +', ' ', response)
+        try:
+            prompt = self.create_study_prompt(question, subject, difficulty, context)
+            
+            logger.info("Streaming study assistance response with Gemini...")
+            
+            async with self._generation_slot() as deadline:
+                async for chunk in gemini_client.stream(
+                    prompt,
+                    generation_config=self._generation_config(),
+                    model_name=self.model_name,
+                    timeout=max(deadline - time.monotonic(), 0.1)
+                ):
+                    text = processor.feed(chunk)
+                    if text:
+                        emitted = True
+                        yield text, 0.95
+            
+            if not emitted:
+                logger.warning("Empty streamed response from Gemini API")
+                yield self._generate_fallback_response(question, subject), 0.5
+                return
+            
+            tail = processor.finish()
+            if tail:
+                yield tail, 0.95
+                
+        except Exception as e:
+            logger.error(f"Error in Gemini streaming: {e!r}")
+            if emitted:
+                # Partial answer already sent; only lower the confidence
+                yield "", 0.3
+            else:
+                yield self._generate_fallback_response(question, subject), 0.3
+    
+    async def summarize_conversation(self, summary: str, messages: List[Dict[str, Any]]) -> str:
+        """Fold older messages into the rolling conversation summary
+        
+        Low priority: the LLM is only used when a Gemini slot is free right away, so summaries never
+        queue behind student questions; otherwise the extractive summary is used.
+        """
+        if not messages:
+            return summary
+        
+        if self.is_loaded and not self.semaphore.locked():
+            transcript = "\n".join(
+                f"{'Học sinh' if m['role'] == 'user' else 'Trợ lý'}: {m['content']}" for m in messages
+            )
+            prompt = (
+                "Tóm tắt ngắn gọn (tối đa 5 câu, tiếng Việt) cuộc trò chuyện học tập dưới đây, "
+                "giữ lại các chủ đề, dữ kiện và kết quả quan trọng để trả lời các câu hỏi tiếp theo.\n\n"
+                f"Tóm tắt trước đó: {summary or '(chưa có)'}\n\n"
+                f"Đoạn hội thoại mới:\n{transcript}"
+            )
+            try:
+                async with self._generation_slot() as deadline:
+                    text = await gemini_client.generate(
+                        prompt,
+                        generation_config=genai.types.GenerationConfig(temperature=0.2, max_output_tokens=256),
+                        model_name=self.model_name,
+                        timeout=max(deadline - time.monotonic(), 0.1)
+                    )
+                if text:
+                    return text.strip()[-self.summary_max_chars:]
+            except Exception as e:
+                logger.warning(f"Conversation summary failed, using extractive summary: {e!r}")
+        
+        return self._extractive_summary(summary, messages)
+    
+    def _extractive_summary(self, summary: str, messages: List[Dict[str, Any]]) -> str:
+        """Cheap summary: student questions and the first sentence of each answer"""
+        lines = [summary] if summary else []
+        for message in messages:
+            content = ' '.join(message['content'].split())
+            if message['role'] == 'user':
+                lines.append(f"Học sinh hỏi: {content[:160]}")
+            else:
+                first_sentence = re.split(r'(?<=[.!?])\s', content, maxsplit=1)[0]
+                lines.append(f"Trợ lý: {first_sentence[:200]}")
+        
+        # Keep the most recent part when over the limit
+        return "\n".join(lines)[-self.summary_max_chars:]
+    
+    def _generation_config(self) -> Any:
+        """Generation settings for study answers"""
+        return genai.types.GenerationConfig(
+            temperature=0.7,
+            top_p=0.95,
+            top_k=40,
+            max_output_tokens=1024,
+        )
+    
+    @asynccontextmanager
+    async def _generation_slot(self) -> AsyncIterator[float]:
+        """Wait for a free Gemini slot; yields the absolute deadline covering queueing and generation"""
+        deadline = time.monotonic() + self.request_timeout
         
-        # Ensure the response ends with proper punctuation
-        if response and not response[-1] in '.!?':
-            response += '.'
+        self.metrics['queue_depth'] += 1
+        self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self.metrics['queue_depth'])
+        wait_start = time.monotonic()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.request_timeout)
+        except asyncio.TimeoutError:
+            self.metrics['timeouts'] += 1
+            raise
+        finally:
+            self.metrics['queue_depth'] -= 1
+            self.metrics['total_wait_time'] += time.monotonic() - wait_start
         
-        return response.strip()
+        self.metrics['in_flight'] += 1
+        try:
+            yield deadline
+            self.metrics['completed'] += 1
+        except asyncio.TimeoutError:
+            self.metrics['timeouts'] += 1
+            raise
+        except Exception:
+            self.metrics['errors'] += 1
+            raise
+        finally:
+            self.metrics['in_flight'] -= 1
+            self.semaphore.release()
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """Get queue and concurrency metrics"""
+        finished = self.metrics['completed'] + self.metrics['timeouts'] + self.metrics['errors']
+        return {
+            'concurrency_limit': self.max_concurrency,
+            'timeout_seconds': self.request_timeout,
+            'queue_depth': self.metrics['queue_depth'],
+            'max_queue_depth': self.metrics['max_queue_depth'],
+            'in_flight': self.metrics['in_flight'],
+            'completed': self.metrics['completed'],
+            'timeouts': self.metrics['timeouts'],
+            'errors': self.metrics['errors'],
+            'avg_wait_time': self.metrics['total_wait_time'] / finished if finished else 0.0
+        }
+    
+    def _post_process_response(self, response: str) -> str:
+        """Post-process the generated response"""
+        # Collapse repeated newlines/spaces, strip, ensure closing punctuation
+        processor = ResponsePostProcessor()
+        return processor.feed(response) + processor.finish()
     
     def _generate_fallback_response(self, question: str, subject: str) -> str:
         """Generate fallback response when Gemini API is not available"""
@@ -426,6 +781,44 @@ class FollowUpGenerator:
         all_questions = specific_questions + base_questions
         return all_questions[:3]
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+def build_conversation_context(summary: str, messages: List[Dict[str, Any]], token_budget: int) -> str:
+    """Summary plus the newest messages that fit within the token budget"""
+    if token_budget <= 0 or (not summary and not messages):
+        return ""
+    
+    parts = []
+    remaining = token_budget
+    
+    if summary:
+        # The summary may take at most half of the budget
+        summary_tokens = min(estimate_tokens(summary), token_budget // 2)
+        parts.append(f"Tóm tắt: {summary[-summary_tokens * 4:]}")
+        remaining -= summary_tokens
+    
+    recent = []
+    for message in reversed(messages):
+        speaker = 'Học sinh' if message['role'] == 'user' else 'Trợ lý'
+        line = f"{speaker}: {message['content']}"
+        tokens = estimate_tokens(line)
+        if tokens > remaining:
+            if not recent and remaining > 16:
+                # Always keep (the tail of) the latest message
+                recent.append(f"{speaker}: ...{message['content'][-(remaining - 8) * 4:]}")
+            break
+        recent.append(line)
+        remaining -= tokens
+    
+    parts.extend(reversed(recent))
+    return "\n".join(parts)
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 class StudyChatService:
     """Main study chat service"""
     
@@ -433,10 +826,18 @@ class StudyChatService:
         self.subject_detector = SubjectDetector()
         self.llm_assistant = StudyAssistantLLM()
         self.follow_up_generator = FollowUpGenerator()
+        self.answer_cache = StudyAnswerCache()
         self.is_initialized = False
         
-        # Conversation memory (simple in-memory cache)
-        self.conversation_memory = {}
+        # Conversation memory (bounded, evicted by the server cleanup task)
+        self.conversation_store = ConversationStore()
+        self.context_token_budget = int(os.getenv('STUDY_CONTEXT_TOKEN_BUDGET', '600'))
+        self.context_recent_messages = int(os.getenv('STUDY_CONTEXT_RECENT_MESSAGES', '6'))
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        # Summaries are debounced per conversation and only run once enough older messages have piled up
+        self.summary_debounce = float(os.getenv('STUDY_SUMMARY_DEBOUNCE_SECONDS', '5'))
+        self.summary_min_messages = int(os.getenv('STUDY_SUMMARY_MIN_MESSAGES', '4'))
+        self.batch_concurrency = int(os.getenv('STUDY_BATCH_CONCURRENCY', str(self.llm_assistant.max_concurrency)))
     
     async def initialize(self) -> bool:
         """Initialize the study chat service"""
@@ -467,16 +868,24 @@ class StudyChatService:
             subject = request.subject or self.subject_detector.detect_subject(request.message)
             
             # Get conversation context
-            conversation_context = []
-            if request.conversation_id and request.conversation_id in self.conversation_memory:
-                conversation_context = self.conversation_memory[request.conversation_id][-3:]  # Last 3 messages
-            
-            # Generate response using LLM
-            response_text, confidence = await self.llm_assistant.generate_response(
-                request.message, 
-                subject, 
-                request.difficulty or "intermediate"
-            )
+            context = await self._conversation_context(request.conversation_id)
+            
+            difficulty = request.difficulty or "intermediate"
+            
+            # Serve repeated questions from the answer cache (follow-ups depend on context, so skip it then)
+            cached_answer = None if context else self.answer_cache.get(request.message, subject, difficulty)
+            if cached_answer is not None:
+                response_text, confidence = cached_answer
+            else:
+                # Generate response using LLM
+                response_text, confidence = await self.llm_assistant.generate_response(
+                    request.message, 
+                    subject, 
+                    difficulty,
+                    context
+                )
+                if confidence >= 0.95 and not context:
+                    self.answer_cache.set(request.message, subject, difficulty, response_text, confidence)
             
             # Generate follow-up questions
             follow_ups = self.follow_up_generator.generate_follow_ups(subject, request.message)
@@ -485,18 +894,7 @@ class StudyChatService:
             related_topics = self._get_related_topics(subject, request.message)
             
             # Store in conversation memory
-            if request.conversation_id:
-                if request.conversation_id not in self.conversation_memory:
-                    self.conversation_memory[request.conversation_id] = []
-                
-                self.conversation_memory[request.conversation_id].extend([
-                    {"role": "user", "content": request.message, "timestamp": datetime.now()},
-                    {"role": "assistant", "content": response_text, "timestamp": datetime.now()}
-                ])
-                
-                # Keep only last 10 exchanges (20 messages)
-                if len(self.conversation_memory[request.conversation_id]) > 20:
-                    self.conversation_memory[request.conversation_id] = self.conversation_memory[request.conversation_id][-20:]
+            self._remember_exchange(request.conversation_id, request.message, response_text)
             
             processing_time = time.time() - start_time
             
@@ -507,7 +905,8 @@ class StudyChatService:
                 confidence=confidence,
                 follow_up_questions=follow_ups,
                 related_topics=related_topics,
-                processing_time=processing_time
+                processing_time=processing_time,
+                cached=cached_answer is not None
             )
             
         except Exception as e:
@@ -524,6 +923,187 @@ class StudyChatService:
                 message=f"Processing error: {str(e)}"
             )
     
+    async def stream_message(self, request: StudyChatRequest) -> AsyncIterator[str]:
+        """Process a study chat message, yielding server-sent events as the answer is generated"""
+        start_time = time.time()
+        
+        try:
+            logger.info(f"Streaming study message: {request.message[:50]}...")
+            
+            # Detect subject if not provided
+            subject = request.subject or self.subject_detector.detect_subject(request.message)
+            
+            context = await self._conversation_context(request.conversation_id)
+            difficulty = request.difficulty or "intermediate"
+            
+            cached_answer = None if context else self.answer_cache.get(request.message, subject, difficulty)
+            if cached_answer is not None:
+                response_text, confidence = cached_answer
+                yield _sse_event('chunk', {'text': response_text})
+            else:
+                parts = []
+                confidence = 0.95
+                async for text, confidence in self.llm_assistant.stream_response(
+                    request.message,
+                    subject,
+                    difficulty,
+                    context
+                ):
+                    if text:
+                        parts.append(text)
+                        yield _sse_event('chunk', {'text': text})
+                
+                response_text = ''.join(parts)
+                if confidence >= 0.95 and not context:
+                    self.answer_cache.set(request.message, subject, difficulty, response_text, confidence)
+            
+            self._remember_exchange(request.conversation_id, request.message, response_text)
+            
+            # Subject, follow-ups and related topics go in the final event
+            final = StudyChatResponse(
+                response=response_text,
+                conversation_id=request.conversation_id,
+                subject_detected=subject,
+                confidence=confidence,
+                follow_up_questions=self.follow_up_generator.generate_follow_ups(subject, request.message),
+                related_topics=self._get_related_topics(subject, request.message),
+                processing_time=time.time() - start_time,
+                cached=cached_answer is not None
+            )
+            yield _sse_event('done', final.model_dump(mode='json'))
+            
+        except Exception as e:
+            logger.error(f"Error streaming study message: {e}")
+            yield _sse_event('error', {
+                'success': False,
+                'message': f"Processing error: {str(e)}",
+                'processing_time': time.time() - start_time
+            })
+    
+    async def iter_batch(self, request: StudyChatBatchRequest) -> AsyncIterator[Tuple[int, StudyChatResponse]]:
+        """Answer worksheet questions concurrently, yielding (index, response) as each completes"""
+        questions = request.questions
+        subjects = [request.subject or self.subject_detector.detect_subject(q) for q in questions]
+        
+        # Dispatch grouped by subject so consecutive prompts share their prefix; identical questions are answered once
+        groups: Dict[Tuple[str, str], List[int]] = {}
+        for i in sorted(range(len(questions)), key=lambda i: (subjects[i], i)):
+            groups.setdefault((normalize_question(questions[i]), subjects[i]), []).append(i)
+        
+        work: asyncio.Queue = asyncio.Queue()
+        for indices in groups.values():
+            work.put_nowait(indices)
+        results: asyncio.Queue = asyncio.Queue()
+        
+        async def worker():
+            while not work.empty():
+                indices = work.get_nowait()
+                start_time = time.time()
+                try:
+                    response = await self.process_message(StudyChatRequest(
+                        message=questions[indices[0]],
+                        subject=subjects[indices[0]],
+                        difficulty=request.difficulty,
+                        language=request.language
+                    ))
+                except Exception as e:
+                    # Every question must yield a result, or the consumer below waits forever
+                    logger.error(f"Error answering batch question {indices[0]}: {e}")
+                    response = StudyChatResponse(
+                        response="Xin lỗi, có lỗi xảy ra khi xử lý câu hỏi của bạn. Vui lòng thử lại hoặc diễn đạt câu hỏi khác cách.",
+                        subject_detected=subjects[indices[0]],
+                        confidence=0.0,
+                        processing_time=time.time() - start_time,
+                        success=False,
+                        message=f"Processing error: {str(e)}"
+                    )
+                for i in indices:
+                    results.put_nowait((i, response))
+        
+        # Bounded fan-out: at most batch_concurrency questions wait on the LLM at once
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.batch_concurrency, len(groups)))]
+        try:
+            for _ in range(len(questions)):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+    
+    async def process_batch(self, request: StudyChatBatchRequest) -> StudyChatBatchResponse:
+        """Answer a worksheet of questions, results in question order"""
+        start_time = time.time()
+        
+        results: List[Optional[StudyChatResponse]] = [None] * len(request.questions)
+        async for index, response in self.iter_batch(request):
+            results[index] = response
+        
+        return StudyChatBatchResponse(
+            results=results,
+            total_questions=len(results),
+            failed_questions=sum(1 for r in results if not r.success),
+            processing_time=time.time() - start_time
+        )
+    
+    async def stream_batch(self, request: StudyChatBatchRequest) -> AsyncIterator[str]:
+        """Answer a worksheet of questions, yielding NDJSON lines as results complete"""
+        start_time = time.time()
+        failed = 0
+        
+        try:
+            async for index, response in self.iter_batch(request):
+                failed += 0 if response.success else 1
+                yield json.dumps({'index': index, 'result': response.model_dump(mode='json')}, ensure_ascii=False) + "\n"
+            
+            yield json.dumps({
+                'done': True,
+                'total_questions': len(request.questions),
+                'failed_questions': failed,
+                'processing_time': time.time() - start_time
+            }) + "\n"
+            
+        except Exception as e:
+            logger.error(f"Error streaming study batch: {e}")
+            yield json.dumps({'done': True, 'success': False, 'message': f"Processing error: {str(e)}"}) + "\n"
+    
+    def _remember_exchange(self, conversation_id: Optional[str], message: str, response_text: str) -> None:
+        """Store a question/answer pair in conversation memory"""
+        if not conversation_id:
+            return
+        
+        self.conversation_store.add_exchange(conversation_id, message, response_text)
+        
+        # Compact older turns in the background (one summary task per conversation at a time)
+        if conversation_id not in self._summary_tasks:
+            task = asyncio.create_task(self._refresh_summary(conversation_id))
+            self._summary_tasks[conversation_id] = task
+            task.add_done_callback(lambda _: self._summary_tasks.pop(conversation_id, None))
+    
+    async def _conversation_context(self, conversation_id: Optional[str]) -> str:
+        """Token-budgeted conversation context for the prompt"""
+        if not conversation_id:
+            return ""
+        
+        await self.conversation_store.load(conversation_id)
+        summary, messages = self.conversation_store.get_context(conversation_id)
+        return build_conversation_context(summary, messages, self.context_token_budget)
+    
+    async def _refresh_summary(self, conversation_id: str) -> None:
+        """Fold messages older than the recent window into the rolling summary"""
+        try:
+            # Let a burst of exchanges settle so they are folded in with one call
+            await asyncio.sleep(self.summary_debounce)
+            
+            summary, pending, summarized = self.conversation_store.pending_summary(
+                conversation_id, self.context_recent_messages
+            )
+            if len(pending) < self.summary_min_messages:
+                return
+            
+            new_summary = await self.llm_assistant.summarize_conversation(summary, pending)
+            self.conversation_store.update_summary(conversation_id, new_summary, summarized)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {conversation_id}: {e}")
+    
     def _get_related_topics(self, subject: str, question: str) -> List[str]:
         """Get related topics based on subject and question"""
         related_topics_map = {
@@ -0,0 +1,102 @@
+import os
+import time
+import asyncio
+
+from cache_utils import BlobCache, LRUCache
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.evictions == 1
+    assert cache.get('b', 'missing') == 'missing'
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_lru_cache_expires_entries_after_ttl():
+    cache = LRUCache(max_size=4, ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+
+    time.sleep(0.06)
+
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_lru_cache_disk_tier_survives_memory_eviction_and_restarts(tmp_path):
+    cache = LRUCache(max_size=1, ttl=60, disk_dir=str(tmp_path))
+    cache.set('plan-a', "Plan A")
+    cache.set('plan-b', "Plan B")
+    assert 'plan-a' not in cache
+
+    assert cache.get('plan-a') == "Plan A"
+    assert cache.disk_hits == 1
+
+    # A fresh process finds the entries on disk
+    restarted = LRUCache(max_size=4, ttl=60, disk_dir=str(tmp_path))
+    assert restarted.get('plan-b') == "Plan B"
+    assert restarted.disk_hits == 1
+
+def test_lru_cache_disk_tier_drops_expired_files(tmp_path):
+    cache = LRUCache(max_size=1, ttl=0.05, disk_dir=str(tmp_path))
+    cache.set('a', 1)
+    cache.clear()
+    time.sleep(0.06)
+
+    assert cache.get('a') is None
+    assert os.listdir(tmp_path) == []
+
+def test_lru_cache_async_accessors_use_the_disk_tier(tmp_path):
+    cache = LRUCache(max_size=1, disk_dir=str(tmp_path))
+
+    async def scenario():
+        await cache.aset('a', {'plan': 1})
+        await cache.aset('b', {'plan': 2})
+        return await cache.aget('a'), await cache.aget('missing', 'default')
+
+    assert asyncio.run(scenario()) == ({'plan': 1}, 'default')
+    assert (cache.disk_hits, cache.misses) == (1, 1)
+
+def test_blob_cache_evicts_least_recently_used_over_quota(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=250)
+    cache.set("a", b'a' * 100)
+    cache.set("b", b'b' * 100)
+    assert cache.get("a") == b'a' * 100  # b is now the least recently used
+
+    cache.set("c", b'c' * 100)
+
+    assert "b" not in cache and not os.path.exists(tmp_path / "b.bin")
+    assert cache.get("c") == b'c' * 100
+    assert (cache.total_bytes, cache.evictions) == (200, 1)
+
+def test_blob_cache_skips_blobs_larger_than_the_quota(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=50)
+    cache.set("big", b'x' * 100)
+
+    assert cache.get("big") is None
+    assert os.listdir(tmp_path) == []
+    assert cache.get_stats().misses == 1
+
+def test_blob_cache_rebuilds_its_index_after_restart(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+    cache.set("old", b'o' * 100)
+    cache.set("new", b'n' * 100)
+    os.utime(tmp_path / "old.bin", (1000, 1000))
+    (tmp_path / "partial.bin.tmp").write_bytes(b'p' * 10)
+
+    restarted = BlobCache(str(tmp_path), max_bytes=150)
+
+    # Oldest access goes first to fit the smaller quota; unfinished writes are ignored
+    assert len(restarted) == 1 and restarted.get("new") == b'n' * 100
+    assert restarted.total_bytes == 100
+
+def test_blob_cache_with_empty_suffix_keys_by_filename(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000, suffix='')
+    cache.set("image.png", b'png')
+
+    assert os.listdir(tmp_path) == ["image.png"]
+    assert "image.png" in BlobCache(str(tmp_path), max_bytes=1000, suffix='')
@@ -0,0 +1,117 @@
+import os
+import asyncio
+
+from conversation_store import MESSAGE_OVERHEAD_BYTES, ConversationStore
+
+# Room for about three 600-byte messages
+BUDGET = 3 * (600 + MESSAGE_OVERHEAD_BYTES)
+
+def _fill(store: ConversationStore, count: int) -> None:
+    for i in range(count):
+        store.append(f"c{i}", 'user', 'x' * 600)
+
+def test_byte_budget_evicts_least_recently_used_conversation():
+    store = ConversationStore(max_bytes=BUDGET, idle_ttl=60, max_messages=10)
+    _fill(store, 3)
+    store.get_context("c0")  # c1 is now the least recently used
+
+    store.append("c3", 'user', 'x' * 600)
+
+    assert "c1" not in store
+    assert all(cid in store for cid in ("c0", "c2", "c3"))
+    assert store.total_bytes <= store.max_bytes
+    assert store.evictions == 1
+    assert store.get_context("c1") == ("", [])
+
+def test_message_history_is_bounded_per_conversation():
+    store = ConversationStore(max_bytes=10 ** 6, idle_ttl=60, max_messages=4)
+    for i in range(6):
+        store.add_exchange("c", f"question {i}", f"answer {i}")
+
+    _, messages = store.get_context("c")
+
+    assert [m['content'] for m in messages] == ["question 4", "answer 4", "question 5", "answer 5"]
+    assert store.total_bytes == sum(len(m['content']) + MESSAGE_OVERHEAD_BYTES for m in messages)
+
+def test_summary_covers_older_messages():
+    store = ConversationStore(max_bytes=10 ** 6, idle_ttl=60, max_messages=20)
+    for i in range(3):
+        store.add_exchange("c", f"q{i}", f"a{i}")
+
+    summary, pending, summarized = store.pending_summary("c", keep_recent=2)
+    assert (summary, summarized) == ("", 4)
+    assert [m['content'] for m in pending] == ["q0", "a0", "q1", "a1"]
+
+    store.update_summary("c", "talked about q0 and q1", summarized)
+    summary, messages = store.get_context("c")
+
+    assert summary == "talked about q0 and q1"
+    assert [m['content'] for m in messages] == ["q2", "a2"]
+    # A stale summary never replaces a newer one
+    store.update_summary("c", "older", 2)
+    assert store.get_context("c")[0] == "talked about q0 and q1"
+
+def test_evicted_conversations_spill_to_disk_and_load_back(tmp_path):
+    store = ConversationStore(max_bytes=BUDGET, idle_ttl=60, max_messages=10, spill_dir=str(tmp_path))
+
+    async def scenario():
+        _fill(store, 4)
+        assert "c0" in store and store.get_stats()['pending_spills'] == 1
+
+        await asyncio.sleep(0.05)  # Background flush
+        assert len(os.listdir(tmp_path)) == 1
+        assert store.get_context("c0") == ("", [])  # Not loaded yet
+
+        await store.load("c0")
+        return store.get_context("c0")
+
+    _, messages = asyncio.run(scenario())
+
+    assert [m['content'] for m in messages] == ['x' * 600]
+    assert store.restored == 1
+    # The load consumed c0's spill file; c1 was evicted to make room for it
+    assert not os.path.exists(store._spill_path("c0"))
+    assert os.path.exists(store._spill_path("c1"))
+
+def test_pending_spill_is_reclaimed_before_it_is_written(tmp_path):
+    store = ConversationStore(max_bytes=BUDGET, idle_ttl=60, max_messages=10, spill_dir=str(tmp_path))
+
+    async def scenario():
+        _fill(store, 4)
+        # Same loop iteration: the flush task has not run yet
+        store.append("c0", 'assistant', 'reply')
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+
+    _, messages = store.get_context("c0")
+    assert [m['role'] for m in messages] == ['user', 'assistant']
+    # c0 never reached the disk; the conversations evicted to make room for it did
+    assert not os.path.exists(store._spill_path("c0"))
+    assert os.path.exists(store._spill_path("c1"))
+
+def test_expired_conversations_are_dropped_not_spilled(tmp_path):
+    store = ConversationStore(max_bytes=10 ** 6, idle_ttl=60, max_messages=10, spill_dir=str(tmp_path))
+    _fill(store, 2)
+    store._conversations["c0"].last_access = 0
+
+    assert store.evict_expired() == 1
+    assert "c0" not in store and "c1" in store
+    assert store.get_stats()['pending_spills'] == 0
+    assert os.listdir(tmp_path) == []
+
+def test_sweep_spills_applies_ttl_and_disk_quota(tmp_path):
+    store = ConversationStore(max_bytes=10 ** 6, idle_ttl=60, max_messages=10, spill_dir=str(tmp_path))
+    for i in range(4):
+        path = tmp_path / f"{i}.json"
+        path.write_bytes(b'x' * 100)
+    os.utime(tmp_path / "0.json", (1000, 1000))
+
+    store.spill_max_bytes = 250
+    removed = asyncio.run(store.sweep_spills())
+
+    # 0.json is past the TTL; of the rest, the oldest goes to get under the quota
+    assert removed == 2
+    assert len(os.listdir(tmp_path)) == 2
+    assert "0.json" not in os.listdir(tmp_path)
+    assert store.get_stats()['spill_expirations'] == 2
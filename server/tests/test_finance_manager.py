@@ -0,0 +1,213 @@
+import json
+import asyncio
+import unicodedata
+
+import finance_manager
+from finance_manager import FinanceAIService, FinanceCommandParser, RecurringPaymentDetector, SpendingAggregator, SpendingAnomalyDetector, build_plan_fingerprint, iter_ndjson_rows
+
+def test_parse_command_memoizes_normalized_command():
+    parser = FinanceCommandParser()
+
+    first = parser.parse_command("25k cafe  sữa")
+    second = parser.parse_command(unicodedata.normalize('NFD', " 25K CAFE sữa "))
+
+    assert first.amount == second.amount == 25000
+    assert first.type == second.type == 'expense'
+    assert parser.parse_cache.misses == 1
+    assert parser.parse_cache.hits == 1
+    assert len(parser.parse_cache) == 1
+
+def test_parse_command_keeps_description_casing_on_cache_hit():
+    parser = FinanceCommandParser()
+
+    assert parser.parse_command("25k cafe highlands").description == "cafe highlands"
+    assert parser.parse_command("25k Cafe Highlands").description == "Cafe Highlands"
+    assert parser.parse_cache.hits == 1
+
+def test_parse_command_caches_unparseable_commands():
+    parser = FinanceCommandParser()
+
+    assert parser.parse_command("xin chào") is None
+    assert parser.parse_command("Xin  chào") is None
+    assert parser.parse_cache.hits == 1
+
+async def _chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+async def _collect_rows(data: bytes, size: int, **kwargs):
+    return [row async for row in iter_ndjson_rows(_chunks(data, size), **kwargs)]
+
+def test_iter_ndjson_rows_reassembles_rows_across_chunks():
+    data = b'{"amount": 1}\n\n{"amount": 2}\r\n{"amount": 3}'
+
+    for size in (1, 3, 7, len(data)):
+        assert asyncio.run(_collect_rows(data, size)) == [{'amount': 1}, {'amount': 2}, {'amount': 3}]
+
+def test_iter_ndjson_rows_reports_malformed_and_oversized_lines():
+    data = b'{"amount": 1}\nnot json\n[1, 2]\n' + b'x' * 100 + b'\n{"amount": 2}\n'
+
+    rows = asyncio.run(_collect_rows(data, 8, max_line_bytes=32))
+
+    assert rows == [{'amount': 1}, None, None, None, {'amount': 2}]
+
+def test_streamed_insights_match_list_insights():
+    transactions = [
+        {'amount': 7000000, 'type': 'income', 'category': 'income', 'date': '2024-01-05'},
+        {'amount': 50000, 'type': 'expense', 'category': 'food_drink', 'date': '2024-01-06'},
+        {'amount': 120000, 'type': 'expense', 'category': 'transport', 'date': '2024-02-10T08:00:00Z'},
+    ]
+    data = b''.join(json.dumps(tx).encode('utf-8') + b'\n' for tx in transactions) + b'garbage\n'
+    service = FinanceAIService()
+
+    streamed = asyncio.run(service.generate_insights_from_stream(iter_ndjson_rows(_chunks(data, 5))))
+    listed = asyncio.run(service.generate_insights(transactions))
+
+    assert streamed.success
+    assert streamed.trends['skipped_rows'] == 1
+    assert streamed.trends['total_expenses'] == listed.trends['total_expenses'] == 170000
+    assert streamed.trends['categories'] == listed.trends['categories']
+    assert streamed.summary == listed.summary
+
+def test_period_trends_cover_every_granularity_in_one_pass():
+    aggregator = SpendingAggregator()
+    for tx in (
+        {'amount': 100, 'type': 'expense', 'date': '2024-01-31'},
+        {'amount': 300, 'type': 'expense', 'date': '2024-03-01'},
+        {'amount': 1000, 'type': 'income', 'date': '2024-12-30'},
+    ):
+        aggregator.add(tx)
+
+    trends = aggregator.result()['period_trends']
+
+    # Gaps are filled so that deltas and rolling averages compare adjacent periods
+    months = trends['month']
+    assert [entry['period'] for entry in months[:3]] == ['2024-01', '2024-02', '2024-03']
+    assert [entry['expenses'] for entry in months[:3]] == [100, 0, 300]
+    assert months[1]['expenses_change'] == -100
+    assert months[2]['expenses_avg_3'] == 400 / 3
+    assert months[2]['expenses_change_pct'] is None  # Previous month had no expenses
+
+    assert trends['quarter'][0]['period'] == '2024-Q1'
+    assert trends['quarter'][0]['expenses'] == 400
+    assert len(trends['year']) == 1
+    assert (trends['year'][0]['income'], trends['year'][0]['net']) == (1000, 600)
+    # 2024-12-30 falls in ISO week 1 of 2025
+    assert trends['week'][0]['period'] == '2024-W05'
+    assert trends['week'][-1]['period'] == '2025-W01'
+
+def test_period_trends_are_capped(monkeypatch):
+    monkeypatch.setattr(finance_manager, 'MAX_PERIOD_BUCKETS', 4)
+    aggregator = SpendingAggregator()
+    aggregator.add({'amount': 1, 'type': 'expense', 'date': '2020-01-01'})
+    aggregator.add({'amount': 1, 'type': 'expense', 'date': '2024-01-01'})
+
+    months = aggregator.result()['period_trends']['month']
+
+    assert [entry['period'] for entry in months] == ['2023-10', '2023-11', '2023-12', '2024-01']
+
+def _anomaly_detector(monkeypatch, **env):
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    return SpendingAnomalyDetector(['food_drink', 'transport', 'other'])
+
+def test_anomaly_detector_flags_outlier_after_warmup(monkeypatch):
+    detector = _anomaly_detector(monkeypatch, FINANCE_ANOMALY_MIN_SAMPLES="5")
+
+    # Not enough history yet: nothing is flagged
+    for amount in (30000, 35000, 28000, 32000, 30000):
+        assert detector.observe('u1', 'food_drink', amount) is None
+
+    anomaly = detector.observe('u1', 'food_drink', 1000000)
+    assert anomaly is not None
+    assert anomaly.category == 'food_drink'
+    assert 25000 < anomaly.typical_amount < 35000
+    assert anomaly.z_score >= detector.z_threshold
+
+    # Other categories and users keep their own history
+    assert detector.observe('u1', 'transport', 1000000) is None
+    assert detector.observe('u2', 'food_drink', 1000000) is None
+
+def test_anomaly_detector_maps_unknown_categories_to_other(monkeypatch):
+    detector = _anomaly_detector(monkeypatch)
+
+    detector.observe('u1', 'mystery', 10000)
+
+    base = detector.category_slots['other'] * detector.SLOT_SIZE
+    assert detector.user_stats['u1'][base] == 1
+
+def test_anomaly_detector_evicts_least_recently_active_user(monkeypatch):
+    detector = _anomaly_detector(monkeypatch, FINANCE_ANOMALY_MAX_USERS="2")
+
+    detector.observe('u1', 'other', 1)
+    detector.observe('u2', 'other', 1)
+    detector.observe('u1', 'other', 1)
+    detector.observe('u3', 'other', 1)
+
+    assert list(detector.user_stats) == ['u1', 'u3']
+
+def test_process_command_reports_anomaly_for_user():
+    service = FinanceAIService()
+    for _ in range(service.anomaly_detector.min_samples):
+        response = asyncio.run(service.process_command("30k cafe", user_id='u1'))
+        assert response.anomaly is None
+
+    response = asyncio.run(service.process_command("2tr cafe", user_id='u1'))
+
+    assert response.anomaly is not None
+    assert response.anomaly.message in response.response_text
+
+def _monthly_rows(description: str, amount: float, months: int, day: int = 5):
+    return [
+        {'amount': amount + month * 1000, 'type': 'expense', 'category': 'entertainment',
+         'description': f"{description} #{month + 1}", 'date': f"2024-{month + 1:02d}-{day:02d}"}
+        for month in range(months)
+    ]
+
+def test_recurring_detector_finds_monthly_subscription():
+    transactions = _monthly_rows("Netflix", 220000, 4) + [
+        {'amount': 50000, 'type': 'expense', 'category': 'food_drink', 'description': 'cafe', 'date': '2024-02-14'},
+        {'amount': 900000, 'type': 'expense', 'category': 'entertainment', 'description': 'Netflix', 'date': '2024-03-20'},
+    ]
+
+    recurring = RecurringPaymentDetector().detect(transactions)
+
+    assert len(recurring) == 1
+    item = recurring[0]
+    assert item['cadence'] == 'monthly'
+    assert item['occurrences'] == 4
+    assert item['amount'] == 222000
+    assert item['last_date'] == '2024-04-05'
+    assert item['next_expected_date'] == '2024-05-05'
+    assert item['description'] == 'Netflix #4'
+
+def test_recurring_detector_ignores_irregular_and_sparse_payments():
+    irregular = [
+        {'amount': 100000, 'type': 'expense', 'description': 'gym', 'date': date}
+        for date in ('2024-01-01', '2024-01-03', '2024-02-20', '2024-06-01')
+    ]
+
+    assert RecurringPaymentDetector().detect(irregular) == []
+    assert RecurringPaymentDetector().detect(_monthly_rows("Spotify", 59000, 2)) == []
+
+def test_streamed_insights_report_recurring_payments():
+    transactions = _monthly_rows("Netflix", 220000, 4)
+    data = b''.join(json.dumps(tx).encode('utf-8') + b'\n' for tx in transactions)
+    service = FinanceAIService()
+
+    streamed = asyncio.run(service.generate_insights_from_stream(iter_ndjson_rows(_chunks(data, 16))))
+    listed = asyncio.run(service.generate_insights(transactions))
+
+    assert streamed.recurring_payments == listed.recurring_payments
+    assert [item['cadence'] for item in streamed.recurring_payments] == ['monthly']
+
+def test_plan_fingerprint_buckets_near_identical_profiles():
+    summary = {
+        'total_income': 5000000, 'total_expenses': 3000000, 'net_amount': 2000000,
+        'category_breakdown': {'food_drink': 1500000, 'transport': 1200000, 'other': 100000}
+    }
+    similar = dict(summary, total_income=5050000, category_breakdown={'food_drink': 1490000, 'transport': 1210000, 'other': 100000})
+
+    assert build_plan_fingerprint(summary, 'saving') == build_plan_fingerprint(similar, 'saving')
+    assert build_plan_fingerprint(summary, 'saving') != build_plan_fingerprint(summary, 'debt')
+    assert build_plan_fingerprint(summary, 'saving') != build_plan_fingerprint(dict(summary, total_income=9000000), 'saving')
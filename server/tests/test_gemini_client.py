@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from gemini_client import CircuitBreaker, CircuitOpenError, GeminiClient, LocalStubProvider
+
+def _client(*providers: LocalStubProvider) -> GeminiClient:
+    client = GeminiClient(api_key="unused", providers=list(providers))
+    client.hedging_enabled = True
+    client.hedge_default_delay = 0.05
+    client.hedge_min_delay = 0.01
+    return client
+
+def _stub(name: str, latency: float = 0.01, failure_rate: float = 0.0, **breaker_settings) -> LocalStubProvider:
+    return LocalStubProvider(name=name, latency=latency, failure_rate=failure_rate, reply=f"{name} answer", **breaker_settings)
+
+def test_generate_uses_preferred_provider():
+    primary, backup = _stub("primary"), _stub("backup")
+    client = _client(primary, backup)
+
+    assert asyncio.run(client.generate("hi")) == "primary answer"
+    assert backup.stats['requests'] == 0
+    assert client.stats['hedged'] == 0
+
+def test_generate_hedges_after_p95_latency():
+    slow, fast = _stub("slow", latency=1.0), _stub("fast")
+    # Slow is usually quick: its p95 puts the hedge well before its actual latency
+    slow.latencies.extend([0.02] * 20)
+    client = _client(slow, fast)
+
+    assert asyncio.run(client.generate("hi", timeout=5)) == "fast answer"
+    assert client.stats['hedged'] == 1
+    assert fast.stats['hedge_wins'] == 1
+    # The losing request is cancelled without counting against its breaker
+    assert slow.stats['cancelled'] == 1
+    assert slow.breaker.consecutive_failures == 0
+
+def test_generate_fails_over_on_error():
+    broken, backup = _stub("broken", failure_rate=1.0), _stub("backup")
+    client = _client(broken, backup)
+    client.hedging_enabled = False
+
+    assert asyncio.run(client.generate("hi")) == "backup answer"
+    assert client.stats['failovers'] == 1
+    assert broken.stats['failures'] == 1
+
+def test_open_breaker_skips_provider_until_reset():
+    broken = _stub("broken", failure_rate=1.0, failure_threshold=1, reset_timeout=0.1)
+    backup = _stub("backup")
+    client = _client(broken, backup)
+    client.hedging_enabled = False
+
+    async def scenario():
+        await client.generate("hi")
+        assert broken.breaker.state == "open"
+
+        # Open: not even tried
+        assert await client.generate("hi") == "backup answer"
+        assert broken.stats['requests'] == 1
+
+        # After the reset timeout one trial call goes through and closes the breaker
+        await asyncio.sleep(0.15)
+        broken.failure_rate = 0.0
+        assert await client.generate("hi") == "broken answer"
+        assert broken.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+def test_generate_raises_when_every_breaker_is_open():
+    only = _stub("only", failure_rate=1.0, failure_threshold=1, reset_timeout=60)
+    client = _client(only)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(client.generate("hi"))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.generate("hi"))
+    assert client.state == "open"
+    assert client.stats['exhausted'] == 2
+
+def test_generate_times_out():
+    slow = _stub("slow", latency=1.0)
+    client = _client(slow)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.generate("hi", timeout=0.05))
+    assert slow.stats['cancelled'] == 1
+
+def test_stream_fails_over_before_first_chunk():
+    broken, backup = _stub("broken", failure_rate=1.0), _stub("backup")
+    client = _client(broken, backup)
+
+    async def collect():
+        return [text async for text in client.stream("hi")]
+
+    assert "".join(asyncio.run(collect())) == "backup answer"
+    assert client.stats['failovers'] == 1
+    assert broken.breaker.consecutive_failures == 1
+    assert backup.stats['successes'] == 1
+
+def test_stream_raises_when_every_provider_fails():
+    client = _client(_stub("a", failure_rate=1.0), _stub("b", failure_rate=1.0))
+
+    async def collect():
+        return [text async for text in client.stream("hi")]
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect())
+    assert client.stats['exhausted'] == 1
+
+def test_half_open_breaker_allows_one_trial():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+
+    breaker.record_failure(RuntimeError("1"))
+    assert breaker.state == "closed"
+    breaker.record_failure(RuntimeError("2"))
+    assert breaker.state == "open"
+
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request()
+
+    # A failed trial reopens immediately
+    breaker.record_failure(RuntimeError("3"))
+    assert breaker.state == "open"
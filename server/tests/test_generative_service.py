@@ -0,0 +1,90 @@
+import os
+import asyncio
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from generative_service import GenerativeService
+from PIL import Image
+
+from models import GenerativeArtRequest, ImageOutputOptions
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.setenv('GENERATED_IMAGES_DIR', str(tmp_path / "images"))
+    monkeypatch.setenv('GENERATED_IMAGES_MAX_MB', str(250 / (1024 * 1024)))
+    monkeypatch.setenv('GENERATION_CACHE_DIR', str(tmp_path / "generations"))
+    return GenerativeService()
+
+def test_url_delivery_is_content_addressed(service):
+    options = ImageOutputOptions(output_format="webp", delivery="url")
+
+    first = service._package_bytes(b'x' * 100, options)
+    again = service._package_bytes(b'x' * 100, options)
+
+    assert first == again
+    assert first['image_base64'] == "" and first['media_type'] == "image/webp"
+    filename = first['image_url'].rsplit('/', 1)[1]
+    assert filename.endswith(".webp")
+    assert os.listdir(service.images_dir) == [filename]
+
+def test_stored_images_stay_within_the_quota(service):
+    options = ImageOutputOptions(delivery="url")
+    urls = [service._package_bytes(bytes([i]) * 100, options)['image_url'] for i in range(3)]
+
+    # 250 bytes hold two images: the oldest is gone
+    stored = sorted(os.listdir(service.images_dir))
+    assert stored == sorted(url.rsplit('/', 1)[1] for url in urls[1:])
+    assert service.image_store.evictions == 1
+
+def test_seeded_generations_are_served_from_the_cache(service):
+    request = GenerativeArtRequest(prompt="a lighthouse", seed=7)
+    image = Image.new("RGB", (8, 8), "red")
+    key = service._generation_key('generative_art', request, 7, service._art_prompts(request))
+    delivered = service._package_image(image, request, cache_key=key)
+
+    cached = asyncio.run(service.lookup_cached('generative_art', request))
+
+    assert cached.cached and cached.seed == 7
+    assert cached.image_base64 == delivered['image_base64']
+    # Anything else that changes the output misses
+    assert asyncio.run(service.lookup_cached('generative_art', request.model_copy(update={'seed': 8}))) is None
+    assert asyncio.run(service.lookup_cached('generative_art', request.model_copy(update={'output_format': "webp"}))) is None
+    assert asyncio.run(service.lookup_cached('generative_art', request.model_copy(update={'seed': None}))) is None
+
+class FakeTensor:
+    def __init__(self, text: str, device: str = "cpu"):
+        self.text = text
+        self.device = device
+
+    def cpu(self):
+        return FakeTensor(self.text)
+
+    def to(self, device):
+        return FakeTensor(self.text, device)
+
+class FakeTextPipeline:
+    """Records text-encoder calls"""
+    _execution_device = "accelerator"
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode_prompt(self, text, device, num_images_per_prompt, do_classifier_free_guidance):
+        self.encoded.append(text)
+        return FakeTensor(text, device), None
+
+def test_art_embeddings_reuse_the_negative_prompt_and_repeated_prompts(service):
+    pipe = FakeTextPipeline()
+
+    first = service._art_prompt_kwargs(pipe, service._art_prompts(GenerativeArtRequest(prompt="a lighthouse")))
+    service._art_prompt_kwargs(pipe, service._art_prompts(GenerativeArtRequest(prompt="a forest")))
+    service._art_prompt_kwargs(pipe, service._art_prompts(GenerativeArtRequest(prompt="a lighthouse")))
+
+    # Negative prompt once, each distinct full prompt once
+    assert len(pipe.encoded) == 3
+    assert first['prompt_embeds'].device == "accelerator"
+    assert first['negative_prompt_embeds'].text == service._get_negative_prompt("art")
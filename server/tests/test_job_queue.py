@@ -0,0 +1,222 @@
+import asyncio
+import types
+
+import pytest
+
+from job_queue import AffinityScheduler, QueueFullError
+
+def _scheduler(handlers, resident=(), **kwargs) -> AffinityScheduler:
+    resident = set(resident)
+    kwargs.setdefault('max_wait', {kind: 60.0 for kind in handlers})
+    return AffinityScheduler(handlers, is_resident=lambda kind: kind in resident, **kwargs)
+
+def test_jobs_run_with_progress_and_results():
+    async def render(job):
+        for step in range(1, 4):
+            job.report_progress(step)
+        return types.SimpleNamespace(success=True, frames=job.request)
+
+    async def scenario():
+        scheduler = _scheduler({'video': render})
+        job = scheduler.submit('video', 16, total_steps=3)
+        assert (job.status, scheduler.queue_position(job)) == ("queued", 1)
+
+        await asyncio.wait_for(job.wait(), timeout=1)
+        await scheduler.stop()
+        return scheduler, job
+
+    scheduler, job = asyncio.run(scenario())
+
+    assert job.status == "done"
+    assert job.result.frames == 16
+    assert job.progress == 1.0 and job.step == 3
+    assert scheduler.get(job.id) is job
+    assert scheduler.stats['completed'] == 1
+
+def test_failures_are_reported_on_the_job():
+    async def broken(job):
+        raise RuntimeError("out of memory")
+
+    async def unsuccessful(job):
+        return types.SimpleNamespace(success=False, message="bad prompt")
+
+    async def scenario():
+        scheduler = _scheduler({'video': broken, 'art': unsuccessful})
+        jobs = [scheduler.submit('video', None), scheduler.submit('art', None)]
+        await asyncio.wait_for(asyncio.gather(*(job.wait() for job in jobs)), timeout=1)
+        await scheduler.stop()
+        return jobs
+
+    raised, unsuccessful_job = asyncio.run(scenario())
+
+    assert (raised.status, raised.error) == ("failed", "out of memory")
+    assert (unsuccessful_job.status, unsuccessful_job.error) == ("failed", "bad prompt")
+
+def test_full_queue_rejects_new_jobs():
+    async def render(job):
+        return "done"
+
+    async def scenario():
+        scheduler = _scheduler({'video': render}, max_queue_size=2)
+        scheduler.submit('video', None)
+        scheduler.submit('video', None)
+        with pytest.raises(QueueFullError):
+            scheduler.submit('video', None)
+        await scheduler.stop()
+        return scheduler
+
+    assert asyncio.run(scenario()).stats['rejected'] == 1
+
+def test_stop_fails_running_and_queued_jobs():
+    async def scenario():
+        running = asyncio.Event()
+
+        async def render(job):
+            running.set()
+            await asyncio.sleep(60)
+
+        scheduler = _scheduler({'video': render})
+        first = scheduler.submit('video', None)
+        second = scheduler.submit('video', None)
+        await running.wait()
+
+        await scheduler.stop()
+        # Waiters return instead of hanging
+        await asyncio.wait_for(asyncio.gather(first.wait(), second.wait()), timeout=1)
+        return scheduler, first, second
+
+    scheduler, first, second = asyncio.run(scenario())
+
+    assert (first.status, first.error) == ("failed", "Cancelled")
+    assert (second.status, second.error) == ("failed", "Scheduler stopped")
+    assert not scheduler.queues['video']
+    assert scheduler.stats['failed'] == 2
+
+def test_prune_forgets_old_finished_jobs():
+    async def render(job):
+        return "done"
+
+    async def scenario():
+        scheduler = _scheduler({'video': render}, result_ttl=0)
+        job = scheduler.submit('video', None)
+        await job.wait()
+        await scheduler.stop()
+        return scheduler, job
+
+    scheduler, job = asyncio.run(scenario())
+
+    assert scheduler.prune() == 1
+    assert scheduler.get(job.id) is None
+
+def _recording_scheduler(order, resident=(), **kwargs) -> AffinityScheduler:
+    async def run(job):
+        order.append(job.request)
+        return "done"
+    return _scheduler({'art': run, 'video': run}, resident=resident, **kwargs)
+
+def _run_all(scheduler: AffinityScheduler, submissions) -> None:
+    async def scenario():
+        # Everything is queued before the worker gets to run
+        jobs = [scheduler.submit(kind, name) for kind, name in submissions]
+        await asyncio.wait_for(asyncio.gather(*(job.wait() for job in jobs)), timeout=1)
+        await scheduler.stop()
+    asyncio.run(scenario())
+
+def test_resident_model_jobs_are_grouped_ahead_of_older_jobs():
+    order = []
+    scheduler = _recording_scheduler(order, resident={'art'})
+
+    _run_all(scheduler, [('video', 'v1'), ('art', 'a1'), ('video', 'v2'), ('art', 'a2')])
+
+    assert order == ['a1', 'a2', 'v1', 'v2']
+    assert scheduler.stats['swaps_avoided'] >= 1
+    # Only the switch from art to video loads a model; the first load is not a swap
+    assert scheduler.stats['swaps'] == 1
+
+def test_overdue_jobs_go_first():
+    order = []
+    scheduler = _recording_scheduler(order, resident={'art'}, max_wait={'art': 60.0, 'video': 1e-9})
+
+    _run_all(scheduler, [('art', 'a1'), ('video', 'v1'), ('art', 'a2')])
+
+    assert order[0] == 'v1'
+    assert scheduler.stats['overdue_dispatches'] >= 1
+
+def test_full_batch_yields_to_other_models():
+    order = []
+    scheduler = _recording_scheduler(order, resident={'art', 'video'}, max_batch=1)
+
+    _run_all(scheduler, [('art', 'a1'), ('art', 'a2'), ('video', 'v1')])
+
+    assert order == ['a1', 'v1', 'a2']
+    assert scheduler.stats['swaps'] == 0  # Both models stay resident
+
+def test_first_cold_load_is_not_a_swap():
+    order = []
+    scheduler = _recording_scheduler(order)
+
+    _run_all(scheduler, [('art', 'a1'), ('art', 'a2')])
+
+    assert scheduler.stats['swaps'] == 0
+
+def test_micro_batches_group_jobs_by_key():
+    batches = []
+
+    async def render(jobs):
+        batches.append([job.request['prompt'] for job in jobs])
+        return [f"{job.request['prompt']} image" for job in jobs]
+
+    async def scenario():
+        scheduler = _scheduler(
+            {'streaming': render},
+            batch_keys={'streaming': lambda request: request['steps']},
+            batch_window=0.01,
+            max_batch_size=2
+        )
+        requests = [{'prompt': 'a', 'steps': 1}, {'prompt': 'b', 'steps': 4}, {'prompt': 'c', 'steps': 1}, {'prompt': 'd', 'steps': 1}]
+        jobs = [scheduler.submit('streaming', request) for request in requests]
+        await asyncio.wait_for(asyncio.gather(*(job.wait() for job in jobs)), timeout=1)
+        await scheduler.stop()
+        return scheduler, jobs
+
+    scheduler, jobs = asyncio.run(scenario())
+
+    # Same step count only, at most two per batch, head of the queue first
+    assert batches == [['a', 'c'], ['b'], ['d']]
+    assert [job.result for job in jobs] == ["a image", "b image", "c image", "d image"]
+    assert (scheduler.stats['batches'], scheduler.stats['batched_jobs']) == (3, 4)
+
+def test_short_batch_result_fails_the_remaining_jobs():
+    async def render(jobs):
+        return ["only one"]
+
+    async def scenario():
+        scheduler = _scheduler({'streaming': render}, batch_keys={'streaming': lambda request: None})
+        jobs = [scheduler.submit('streaming', None) for _ in range(2)]
+        await asyncio.wait_for(asyncio.gather(*(job.wait() for job in jobs)), timeout=1)
+        await scheduler.stop()
+        return jobs
+
+    first, second = asyncio.run(scenario())
+
+    assert (first.status, first.result) == ("done", "only one")
+    assert (second.status, second.error) == ("failed", "No result returned")
+
+def test_previews_stop_once_the_listener_detaches():
+    previews = []
+
+    async def render(job):
+        job.report_preview(1, "first")
+        job.preview_callback = None  # Listener disconnected mid-generation
+        job.report_preview(2, "second")
+        return "done"
+
+    async def scenario():
+        scheduler = _scheduler({'art': render})
+        job = scheduler.submit('art', None, preview_callback=lambda step, image: previews.append((step, image)))
+        await asyncio.wait_for(job.wait(), timeout=1)
+        await scheduler.stop()
+        return job
+
+    assert asyncio.run(scenario()).status == "done"
+    assert previews == [(1, "first")]
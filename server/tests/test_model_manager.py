@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from model_manager import ModelManager
+
+class FakePipeline:
+    """Stands in for a diffusers pipeline: only device moves are observed"""
+
+    def __init__(self, fail_on: str = None):
+        self.device = "cpu"
+        self.fail_on = fail_on
+
+    def to(self, device, **kwargs):
+        if device == self.fail_on:
+            raise RuntimeError(f"cannot move to {device}")
+        self.device = device
+        return self
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setenv('MODEL_FOOTPRINTS_PATH', str(tmp_path / "footprints.json"))
+    monkeypatch.setenv('MODEL_MEMORY_BUDGET_MB', "5000")
+    manager = ModelManager()
+    manager.device = "accelerator"
+    manager.parking_enabled = True
+    manager.pin_parked_memory = False
+    manager.ram_tier_budget_mb = 10 ** 6
+    return manager
+
+def _resident(manager: ModelManager, *model_types: str) -> dict:
+    pipelines = {}
+    for model_type in model_types:
+        pipelines[model_type] = FakePipeline().to(manager.device)
+        manager.models[model_type] = pipelines[model_type]
+        manager.currently_loaded.add(model_type)
+        manager.touch(model_type)
+    return pipelines
+
+def test_make_room_evicts_least_recently_used_until_within_budget(manager):
+    # Estimates: art 2500MB, streaming 2000MB, video 4500MB; budget 5000MB
+    _resident(manager, 'generative_art', 'streaming_generative')
+    manager.touch('generative_art')
+
+    evicted = asyncio.run(manager._make_room('generative_video'))
+
+    assert evicted == ['streaming_generative', 'generative_art']
+    assert manager.currently_loaded == set()
+
+def test_make_room_keeps_models_that_still_fit(manager):
+    _resident(manager, 'streaming_generative')
+
+    assert asyncio.run(manager._make_room('generative_art')) == []
+    assert manager.currently_loaded == {'streaming_generative'}
+
+def test_explicit_unload_frees_instead_of_parking(manager):
+    _resident(manager, 'generative_art', 'streaming_generative')
+
+    assert asyncio.run(manager.unload_model('generative_art'))
+    assert 'generative_art' in manager.parked  # Eviction path parks
+
+    assert asyncio.run(manager.unload_model('streaming_generative', park=False))
+    assert 'streaming_generative' not in manager.parked
+
+    # park=False also releases a copy parked earlier
+    assert asyncio.run(manager.unload_model('generative_art', park=False))
+    assert manager.parked == {}
+
+def test_parked_pipeline_is_promoted_back_to_the_device(manager):
+    pipeline = _resident(manager, 'generative_art')['generative_art']
+    asyncio.run(manager.unload_model('generative_art'))
+    assert pipeline.device == "cpu"
+
+    assert manager._promote('generative_art')
+
+    assert pipeline.device == manager.device
+    assert manager.models['generative_art'] is pipeline
+    assert 'generative_art' not in manager.parked
+    assert manager.residency_stats['promotions'] == 1
+
+def test_failed_promotion_keeps_the_parked_copy(manager):
+    pipeline = FakePipeline(fail_on=manager.device)
+    manager.parked['generative_art'] = pipeline
+    manager.parked_mb['generative_art'] = 0.0
+
+    assert not manager._promote('generative_art')
+
+    assert manager.parked['generative_art'] is pipeline
+    assert 'generative_art' not in manager.currently_loaded
+
+def test_parking_respects_the_ram_budget(manager, monkeypatch):
+    monkeypatch.setattr('model_manager.module_bytes', lambda model: 600 * 1024 * 1024)
+    manager.ram_tier_budget_mb = 1000
+    _resident(manager, 'generative_art', 'streaming_generative')
+
+    asyncio.run(manager.unload_model('generative_art'))
+    asyncio.run(manager.unload_model('streaming_generative'))
+
+    # Least recently parked goes first
+    assert list(manager.parked) == ['streaming_generative']
+    assert manager.residency_stats['ram_evictions'] == 1
+
+def test_measured_footprints_replace_estimates_and_persist(manager):
+    assert manager.model_footprint_mb('generative_art') == 2500  # Configured estimate
+    manager.models['generative_art'] = FakePipeline()
+
+    manager._record_footprint('generative_art', manager._memory_snapshot())
+    measured = manager.model_footprint_mb('generative_art')
+
+    assert measured == manager.footprints[f"generative_art@{manager.device}"]['footprint_mb']
+    assert measured != 2500
+    # Another process on the same device reuses the measurement
+    restarted = ModelManager()
+    restarted.device = manager.device
+    assert restarted.model_footprint_mb('generative_art') == measured
+
+def test_models_in_use_are_neither_evicted_nor_unloaded(manager):
+    _resident(manager, 'generative_art', 'streaming_generative')
+
+    with manager.using('generative_art'):
+        assert manager.is_in_use('generative_art')
+        assert manager._lru_victim(exclude='generative_video') == 'streaming_generative'
+        assert not asyncio.run(manager.unload_model('generative_art', park=False))
+        assert 'generative_art' in manager.currently_loaded
+
+    assert not manager.is_in_use('generative_art')
+    assert asyncio.run(manager.unload_model('generative_art', park=False))
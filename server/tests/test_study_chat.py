@@ -0,0 +1,151 @@
+import json
+import asyncio
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from models import StudyChatBatchRequest, StudyChatResponse
+from study_chat import StudyAnswerCache, StudyChatService, build_conversation_context, estimate_tokens, normalize_question
+
+def test_normalize_question_ignores_case_spacing_and_tone_mark_placement():
+    assert normalize_question("  Cân bằng  phương trình HOÀ tan? ") == normalize_question("cân bằng phương trình hòa tan")
+    # Diacritics and operators still distinguish questions
+    assert normalize_question("ba") != normalize_question("bà")
+    assert normalize_question("2 + 3") != normalize_question("2 - 3")
+
+def test_answer_cache_hits_on_normalized_question_per_subject_and_difficulty():
+    cache = StudyAnswerCache()
+    cache.set("Đạo hàm của x^2 là gì?", 'toán', 'beginner', "2x", 0.9)
+
+    assert cache.get("đạo hàm của x^2 là gì", 'toán', 'beginner') == ("2x", 0.9)
+    assert cache.get("đạo hàm của x^2 là gì", 'toán', 'advanced') is None
+    assert cache.get("đạo hàm của x^2 là gì", 'lý', 'beginner') is None
+    assert (cache.exact_hits, cache.misses) == (1, 2)
+
+def test_answer_cache_near_duplicates_are_opt_in(monkeypatch):
+    question = "Nêu ý nghĩa lịch sử của chiến thắng Điện Biên Phủ năm 1954"
+    rephrased = "Nêu ý nghĩa lịch sử của chiến thắng Điện Biên Phủ năm 1954 là gì"
+
+    exact_only = StudyAnswerCache()
+    exact_only.set(question, 'sử', 'intermediate', "answer", 0.9)
+    assert exact_only.get(rephrased, 'sử', 'intermediate') is None
+
+    monkeypatch.setenv('STUDY_CACHE_NEAR_DUPLICATES', 'True')
+    monkeypatch.setenv('STUDY_CACHE_SIMILARITY', '0.7')
+    cache = StudyAnswerCache()
+    cache.set(question, 'sử', 'intermediate', "answer", 0.9)
+
+    assert cache.get(rephrased, 'sử', 'intermediate') == ("answer", 0.9)
+    assert cache.near_hits == 1
+    assert cache.get(rephrased, 'toán', 'intermediate') is None
+
+def test_answer_cache_forgets_signatures_of_evicted_answers(monkeypatch):
+    monkeypatch.setenv('STUDY_CACHE_NEAR_DUPLICATES', 'True')
+    monkeypatch.setenv('STUDY_CACHE_SIZE', '1')
+    cache = StudyAnswerCache()
+
+    cache.set("câu hỏi thứ nhất về hình học", 'toán', 'beginner', "a", 0.9)
+    cache.set("câu hỏi thứ hai về đại số", 'toán', 'beginner', "b", 0.9)
+
+    assert len(cache._signatures) == 1
+    assert all(len(bucket) == 1 for bucket in cache._lsh_buckets.values())
+
+def _message(role: str, content: str):
+    return {'role': role, 'content': content}
+
+def test_conversation_context_keeps_newest_messages_within_budget():
+    messages = [_message('user', 'q' * 40), _message('assistant', 'a' * 40), _message('user', 'latest question')]
+
+    context = build_conversation_context("", messages, token_budget=20)
+
+    # Oldest first; the oldest message no longer fits
+    assert context.splitlines() == ["Trợ lý: " + 'a' * 40, "Học sinh: latest question"]
+    assert sum(estimate_tokens(line) for line in context.splitlines()) <= 20
+
+def test_conversation_context_caps_summary_and_truncates_latest_message():
+    context = build_conversation_context("s" * 400, [_message('user', 'x' * 400)], token_budget=60)
+    summary_line, message_line = context.splitlines()
+
+    assert summary_line.startswith("Tóm tắt: ") and len(summary_line) <= len("Tóm tắt: ") + 30 * 4
+    assert message_line.startswith("Học sinh: ...") and message_line.endswith('x')
+    assert build_conversation_context("", [], token_budget=60) == ""
+
+def test_refresh_summary_waits_for_enough_older_messages(monkeypatch):
+    service = StudyChatService()
+    service.summary_debounce = 0
+    service.summary_min_messages = 4
+    service.context_recent_messages = 2
+    calls = []
+
+    async def summarize(summary, messages):
+        calls.append([m['content'] for m in messages])
+        return f"summary of {len(messages)}"
+
+    monkeypatch.setattr(service.llm_assistant, 'summarize_conversation', summarize)
+
+    async def scenario():
+        service.conversation_store.add_exchange("c", "q0", "a0")
+        service.conversation_store.add_exchange("c", "q1", "a1")
+        await service._refresh_summary("c")  # Only 2 messages beyond the recent window
+        service.conversation_store.add_exchange("c", "q2", "a2")
+        await service._refresh_summary("c")
+        return await service._conversation_context("c")
+
+    context = asyncio.run(scenario())
+
+    assert calls == [["q0", "a0", "q1", "a1"]]
+    assert context.splitlines() == ["Tóm tắt: summary of 4", "Học sinh: q2", "Trợ lý: a2"]
+
+def _batch_service(monkeypatch, answer):
+    service = StudyChatService()
+    service.batch_concurrency = 2
+    monkeypatch.setattr(service, 'process_message', answer)
+    return service
+
+def test_batch_answers_in_question_order_with_bounded_fan_out(monkeypatch):
+    asked = []
+    in_flight = [0, 0]  # current, peak
+
+    async def answer(request):
+        asked.append(request.message)
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.01 if request.message.startswith("slow") else 0)
+        in_flight[0] -= 1
+        return StudyChatResponse(response=f"answer to {request.message}")
+
+    service = _batch_service(monkeypatch, answer)
+    questions = ["slow question", "Câu 2?", "câu 2", "câu 3"]
+
+    batch = asyncio.run(service.process_batch(StudyChatBatchRequest(questions=questions)))
+
+    assert [r.response for r in batch.results] == [
+        "answer to slow question", "answer to Câu 2?", "answer to Câu 2?", "answer to câu 3"
+    ]
+    # Identical questions (after normalization) are asked once
+    assert len(asked) == 3
+    assert in_flight[1] <= service.batch_concurrency
+    assert batch.failed_questions == 0
+
+def test_batch_reports_failed_questions_instead_of_hanging(monkeypatch):
+    async def answer(request):
+        if request.message == "bad":
+            raise RuntimeError("boom")
+        return StudyChatResponse(response="ok")
+
+    service = _batch_service(monkeypatch, answer)
+
+    async def scenario():
+        request = StudyChatBatchRequest(questions=["bad", "good", "bad"])
+        batch = await asyncio.wait_for(service.process_batch(request), timeout=5)
+        lines = [json.loads(line) async for line in service.stream_batch(request)]
+        return batch, lines
+
+    batch, lines = asyncio.run(scenario())
+
+    assert [r.success for r in batch.results] == [False, True, False]
+    assert batch.failed_questions == 2
+    assert "boom" in batch.results[0].message
+    assert lines[-1]['done'] and lines[-1]['failed_questions'] == 2
+    assert sorted(line['index'] for line in lines[:-1]) == [0, 1, 2]